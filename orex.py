@@ -1,42 +1,325 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, flash, jsonify
-from sqlalchemy import create_engine, inspect, text
+from flask import Flask, render_template, request, redirect, url_for, session, send_file, flash, jsonify, \
+    Response, stream_template, stream_with_context, make_response, has_request_context, g
+from sqlalchemy import create_engine, inspect, text, bindparam, event
+from sqlalchemy.engine import URL, Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
 import os
 import io
-from datetime import datetime, date
-import tempfile
-import shutil
+import re
+import bisect
+import heapq
+import functools
+import struct
+import zlib
+from datetime import datetime, date, timedelta
+from collections import OrderedDict
 import zipfile
-import xml.etree.ElementTree as ET
+import gzip
 import uuid
+import shutil
 from werkzeug.utils import secure_filename
 from werkzeug.middleware.proxy_fix import ProxyFix
 import logging
+import logging.handlers
+import queue
+import atexit
 import json
+import threading
+import time
+import csv
+import itertools
+import sqlite3
+import subprocess
+import pathlib
+import sys
+import argparse
+import tempfile
+from contextlib import closing, contextmanager
+from collections import deque
+from xml.etree import ElementTree
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xml.sax.saxutils import escape as xml_escape, unescape as xml_unescape
+import string
+import base64
+import hashlib
+from cryptography.fernet import Fernet, InvalidToken
+
+try:
+    import fcntl
+except ImportError:  # Windows - там запускаем один процесс
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:  # Без пакета zstandard бэкапы сжимаются gzip
+    zstandard = None
+
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+except ImportError:  # python3-uno ставится вместе с LibreOffice в системный Python, в venv его может не быть
+    uno = None
+
+# Настройка логгирования.
+# Запросы только кладут записи в очередь, в файлы их пишет фоновый поток -
+# запись на SD-карту Orange Pi не задерживает ответы
+LOG_DIR = os.environ.get('OREX_LOG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs'))
+APP_LOG = 'orex.log'
+AUDIT_LOG = 'audit.jsonl'  # Входы и изменения записей, по JSON-объекту на строку
+LOG_MAX_BYTES = 5 * 1024 * 1024  # Файл лога поворачивается по размеру и в полночь
+LOG_BACKUP_COUNT = 10  # Сколько старых файлов хранить (.1 - самый свежий)
+LOG_LEVEL = os.environ.get('OREX_LOG_LEVEL', 'INFO')
+# Уровни по модулям; дополняются переменной OREX_LOG_LEVELS="orex=DEBUG,sqlalchemy.engine=INFO"
+LOG_LEVELS = {'sqlalchemy': 'WARNING', 'werkzeug': 'INFO'}
+
+class RotatingLogFileHandler(logging.handlers.RotatingFileHandler):
+    """Ротация по размеру и раз в сутки, архивы нумеруются .1, .2 и т.д.
+    
+    В файл пишут все воркеры gunicorn, поэтому поворот делается под блокировкой
+    файла .lock, а время последнего поворота хранится в нем же: кто пришел
+    вторым, просто переоткрывает уже новый файл.
+    """
+
+    def __init__(self, filename, max_bytes, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.lock_filename = filename + '.lock'
+        self.rollover_at = self.next_midnight()
+
+    @staticmethod
+    def next_midnight():
+        return datetime.combine(date.today() + timedelta(days=1), datetime.min.time()).timestamp()
+
+    def shouldRollover(self, record):
+        if time.time() >= self.rollover_at:
+            return True
+        # Файл уже повернул другой процесс - пишем в новый
+        if self.stream is not None:
+            try:
+                if os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino:
+                    self.stream.close()
+                    self.stream = None
+            except FileNotFoundError:
+                self.stream.close()
+                self.stream = None
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        with open(self.lock_filename, 'a+', encoding='utf-8') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            lock.seek(0)
+            try:
+                last_rollover = float(lock.read() or 0)
+            except ValueError:
+                last_rollover = 0
+            
+            try:
+                size = os.path.getsize(self.baseFilename)
+            except OSError:
+                size = 0
+            
+            # Суточный поворот после полуночи rollover_at мог уже сделать другой процесс
+            time_due = time.time() >= self.rollover_at and last_rollover < self.rollover_at
+            if time_due or size >= self.maxBytes:
+                super().doRollover()
+                lock.seek(0)
+                lock.truncate()
+                lock.write(str(time.time()))
+                lock.flush()
+            elif self.stream is not None:
+                self.stream.close()
+                self.stream = None
+        self.rollover_at = self.next_midnight()
 
-# Настройка логгирования
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+class JsonLinesFormatter(logging.Formatter):
+    """Запись аудита - одна строка JSON: время, событие и поля из extra={'audit': ...}"""
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='seconds'),
+                 'event': record.getMessage()}
+        entry.update(getattr(record, 'audit', {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+log_queue = queue.SimpleQueue()
+log_listener = None
+
+def setup_logging():
+    """Корневой логгер пишет в очередь; фоновый поток раздает записи по файлам и в консоль"""
+    global log_listener
+    os.makedirs(LOG_DIR, exist_ok=True)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    not_audit = lambda record: record.name != 'orex.audit'
+    
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+    console_handler.addFilter(not_audit)
+    
+    app_handler = RotatingLogFileHandler(os.path.join(LOG_DIR, APP_LOG), LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+    app_handler.setFormatter(formatter)
+    app_handler.addFilter(not_audit)
+    
+    audit_handler = RotatingLogFileHandler(os.path.join(LOG_DIR, AUDIT_LOG), LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+    audit_handler.setFormatter(JsonLinesFormatter())
+    audit_handler.addFilter(logging.Filter('orex.audit'))
+    
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL.upper())
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    
+    levels = dict(LOG_LEVELS)
+    for item in os.environ.get('OREX_LOG_LEVELS', '').split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip()
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level.upper())
+    logging.getLogger('orex.audit').setLevel(logging.INFO)
+    
+    log_listener = logging.handlers.QueueListener(log_queue, console_handler, app_handler, audit_handler,
+                                                  respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+setup_logging()
 logger = logging.getLogger(__name__)
+audit_logger = logging.getLogger('orex.audit')
+
+def audit(event, **fields):
+    """Запись в журнал аудита (audit.jsonl); IP и пользователь БД берутся из запроса"""
+    if has_request_context():
+        fields.setdefault('ip', get_remote_address())
+        if session.get('logged_in') and session.get('engine_key'):
+            with engines_lock:
+                entry = engines.get(session['engine_key'])
+            if entry is not None:
+                fields.setdefault('user', entry['engine'].url.username)
+    audit_logger.info(event, extra={'audit': fields})
+
+def load_secret_key():
+    """Ключ сессий, общий для всех воркеров и перезапусков.
+    
+    Берется из переменной OREX_SECRET_KEY, иначе из файла .orex-secret-key
+    рядом с orex.py (файл создается автоматически при первом запуске).
+    """
+    if os.environ.get('OREX_SECRET_KEY'):
+        return os.environ['OREX_SECRET_KEY']
+    
+    key_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.orex-secret-key')
+    try:
+        # O_EXCL: если воркеры стартуют одновременно, файл создаст только один
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):
+            with open(key_file, 'r', encoding='utf-8') as f:
+                key = f.read().strip()
+            if key:
+                return key
+            time.sleep(0.1)  # другой воркер еще пишет ключ
+        raise RuntimeError(f"Пустой файл ключа сессий: {key_file}")
+    
+    key = os.urandom(24).hex()
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(key)
+    return key
 
 # Создаем экземпляр Flask приложения
 orex = Flask(__name__)
-orex.secret_key = os.urandom(24).hex()  # Автогенерация ключа
+orex.secret_key = load_secret_key()
 orex.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
 
 # Fix для работы за прокси - УПРОЩАЕМ ДО МИНИМУМА
 orex.wsgi_app = ProxyFix(orex.wsgi_app, x_proto=1, x_host=1)
 
-# Глобальный движок для упрощения
-engine = None
+# Движки БД по сессиям пользователей: ключ сессии -> движок с пулом соединений
+engines = {}
+engines_lock = threading.Lock()
+engines_last_eviction = 0.0
 
 # Константы
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PRINT_TEMPLATES_DIR = os.path.join(BASE_DIR, 'print-templates')
 ALLOWED_EXTENSIONS = {'odt'}
+ODT_COMPRESS_LEVEL = 6  # Сжатие частей документа с подставленными данными
+DOCUMENT_MIMETYPES = {'odt': 'application/vnd.oasis.opendocument.text', 'pdf': 'application/pdf'}
+DOCUMENT_WORKERS = 4  # Потоков для пакетной генерации документов
+BATCH_MAX_ROWS = 500  # Максимум писем в одном пакете
+BULK_EDIT_MAX_ROWS = 500  # Максимум записей в одной групповой правке
+JOBS_DB = 'orex-jobs.sqlite'  # Фоновые задачи (общий для воркеров файл SQLite)
+JOBS_DIR = 'generated'  # Готовые файлы фоновых задач
+JOB_WORKERS = 2  # Сколько фоновых задач процесс выполняет одновременно
+JOB_RESULT_TTL = 3600  # Сколько секунд хранится готовый файл задачи
+REPLY_RULES_FILE = 'reply-rules.json'  # Правила создания исходящих записей при генерации ответа
+OUTGOING_COUNTERS_TABLE = 'orex_outgoing_counters'  # Последние выданные номера исходящих (таблица, год) в БД пользователя
+OUTGOING_LINKS_TABLE = 'orex_outgoing_links'  # Какая исходящая запись создана для письма (повторный ответ берет ее же)
+DOCUMENT_CACHE_DIR = 'document-cache'  # Готовые ответы: повторное скачивание не генерирует документ заново
+DOCUMENT_CACHE_MAX_BYTES = 256 * 1024 * 1024  # Место под кэш ответов на диске
+DOCUMENT_CACHE_RESCAN_PUTS = 32  # Папку кэша пополняют все воркеры: ее размер пересчитывается через столько записей
+SOFFICE = os.environ.get('OREX_SOFFICE') or shutil.which('soffice') or shutil.which('libreoffice')  # Без него PDF нет
+PDF_WORKERS = int(os.environ.get('OREX_PDF_WORKERS', 1))  # Процессов soffice на воркер (каждый ~150 МБ памяти)
+PDF_START_TIMEOUT = 60  # Запуск soffice на ARM (первый запуск еще и создает профиль)
+PDF_TIMEOUT = 60  # Дольше конвертирует - soffice завис: процесс убивается и перезапускается
+PDF_QUEUE_TIMEOUT = 120  # Сколько документ ждет свободный soffice
+PDF_PROFILE_DIR = 'soffice-profiles'  # Профили soffice переживают перезапуск - следующий старт быстрее
+SEARCH_INDEX_TTL = 300  # Через сколько секунд индекс поиска перестраивается (правки через Adminer)
+SEARCH_INDEX_MAX_TABLES = 8  # Сколько таблиц держим проиндексированными в памяти
+SEARCH_CANDIDATES_CHUNK = 1000  # Сколько найденных ключей проверяем одним запросом
+SUGGEST_INDEX_TTL = 600  # Через сколько секунд индекс подсказок перестраивается (правки через Adminer)
+SUGGEST_MAX_COLUMNS = 32  # Сколько колонок держим с индексом подсказок в памяти
+SUGGEST_MAX_VALUE_LENGTH = 200  # Значения длиннее - тексты писем, а не адресаты: в подсказки не попадают
+SUGGEST_LIMIT = 10  # Подсказок в одном ответе
+
+# Пул соединений каждого пользователя
+ENGINE_POOL_SIZE = 3
+ENGINE_MAX_OVERFLOW = 2
+ENGINE_POOL_RECYCLE = 3600  # Меньше wait_timeout MariaDB, чтобы не получать "server has gone away"
+ENGINE_IDLE_TIMEOUT = 4 * 3600  # Движок без запросов дольше этого закрывается
+CREDENTIALS_STORE = 'orex-sessions.sqlite'  # Данные подключения сессий (общий для воркеров файл SQLite)
+SESSION_IDLE_TIMEOUT = 8 * 3600  # Сессия без запросов дольше этого забывается - нужен новый вход
+SESSION_RECHECK_INTERVAL = 60  # Как часто движок в памяти сверяется с хранилищем (выход в другом воркере)
+TABLE_PAGE_SIZE = 100  # Строк на странице таблицы
+TABLE_MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500  # Строк за одно чтение с серверного курсора
+STREAM_CHUNK_SIZE = 64 * 1024  # Размер куска ответа при потоковой отдаче
+SCHEMA_CACHE_TTL = 300  # Сколько секунд доверяем кэшу структуры таблиц
+SCHEMA_CHECK_CREATE_TIME = True  # Продлевать кэш, если CREATE_TIME таблицы не изменился
+PAGE_CACHE_MAX_BYTES = 16 * 1024 * 1024  # Память под готовые страницы таблиц
+PAGE_CACHE_TTL = 60  # Без UPDATE_TIME (SQLite, MariaDB после перезапуска) - сколько секунд верим кэшу страниц
+IMPORT_BATCH_SIZE = 500  # Строк в одном executemany при импорте
+IMPORT_MAX_CONTENT_LENGTH = 1024 * 1024 * 1024  # Лимит файла импорта (загрузка идет во временный файл, не в память)
+IMPORT_MAX_ERRORS = 200  # Сколько ошибок по строкам показываем после импорта
+REPORTS_FILE = 'reports.json'  # Какие колонки сводить в отчеты; без файла - дата, статус, галочка, адресат
+REPORT_SUMMARY_TABLE = 'orex_report_summary'  # Сводки отчетов в БД пользователя (создаются при первом отчете)
+REPORT_STATE_TABLE = 'orex_report_state'  # Водяной знак сводки: последний учтенный первичный ключ
+REPORT_CATEGORY_HINTS = ('статус', 'галочка', 'адресат')  # Колонки-категории для таблиц без правила
+REPORT_CHUNK_ROWS = 20000  # Строк за один запрос досчета - короткие запросы не держат живую таблицу
+REPORT_REBUILD_INTERVAL = 24 * 3600  # Полный пересчет сводки (правки через Adminer) - раз в сутки
+REPORT_MAX_CATEGORIES = 15  # Столбцов в отчете; остальные значения сводятся в "прочие"
+REPORT_CATEGORY_LENGTH = 191  # Длина значения в сводке (ключ utf8mb4 укладывается в лимит InnoDB)
+BACKUP_DIR = os.environ.get('OREX_BACKUP_DIR', '/var/orex/backups')  # Куда складывает бэкапы tools/setup-backup.sh
+BACKUP_CONFIG = '/etc/orex/.backup.conf'  # Данные подключения для бэкапа (создает tools/setup-backup.sh)
+BACKUP_MANIFEST = 'manifest.json'  # Список бэкапов с картами кусков таблиц (его же читает страница бэкапов)
+BACKUP_COMPRESSION = os.environ.get('OREX_BACKUP_COMPRESSION', 'gzip')  # gzip или zstd (нужен пакет zstandard)
+BACKUP_COMPRESS_LEVEL = 6
+BACKUP_CHUNK_ROWS = 1000  # Значений ключа в куске: в инкрементальный бэкап попадают только измененные куски
+BACKUP_FULL_INTERVAL = 7 * 24 * 3600  # Полный снимок раз в неделю, между ними - инкрементальные
+BACKUP_KEEP_FULL = 4  # Сколько цепочек (полный снимок + его инкрементальные) хранить
+BACKUP_VERIFY_INTERVAL = 24 * 3600  # Проверка восстановления во временную SQLite - не чаще раза в сутки
 
 # Security configuration
 SECURITY_WHITELIST = 'security_whitelist.txt'
 SECURITY_BLACKLIST = 'security_blacklist.txt'
-LOGIN_LOG = 'login-log.txt'
+LOGIN_THROTTLE_STORE = 'login-throttle.sqlite'  # Общий для воркеров файл SQLite или 'memory' (только этот процесс)
+LOGIN_MAX_FAILURES = 3  # Неудачных входов за окно, после которых IP блокируется
+LOGIN_FAILURE_WINDOW = 15 * 60  # Скользящее окно подсчета неудачных входов, секунд
+LOGIN_THROTTLE_MAX_IPS = 10000  # Сколько IP помнит хранилище в памяти
+METRICS_DIR = os.environ.get('OREX_METRICS_DIR', os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'orex-metrics'))  # Метрики воркеров (в памяти)
+METRICS_FLUSH_INTERVAL = 15  # Как часто воркер сбрасывает свои метрики для /metrics, секунд
+METRICS_ARCHIVE = 'archived.json'  # Счетчики завершившихся воркеров - суммы не уменьшаются при их перезапуске
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Границы гистограмм, секунд
+METRICS_ALLOWED_IPS = set(os.environ.get('OREX_METRICS_IPS', '127.0.0.1,::1').split(','))  # Prometheus без входа
 ALLOWED_BROWSERS = ['Chrome', 'Firefox', 'Safari', 'Edge', 'OPR']  # Разрешенные браузеры
 
 # Создаем папку для шаблонов, если ее нет
@@ -44,6 +327,410 @@ if not os.path.exists(PRINT_TEMPLATES_DIR):
     os.makedirs(PRINT_TEMPLATES_DIR)
     logger.info(f"Created templates directory: {PRINT_TEMPLATES_DIR}")
 
+# Функции для работы с движками БД
+def create_user_engine(host, user, password, database):
+    """Движок с настроенным пулом соединений для одного пользователя"""
+    port = None
+    if ':' in host:
+        host, port = host.rsplit(':', 1)
+        port = int(port)
+    
+    url = URL.create('mysql+pymysql', username=user, password=password,
+                     host=host, port=port, database=database)
+    return create_engine(
+        url,
+        poolclass=QueuePool,
+        pool_size=ENGINE_POOL_SIZE,
+        max_overflow=ENGINE_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=ENGINE_POOL_RECYCLE
+    )
+
+def register_engine(eng, key=None):
+    """Регистрирует движок, возвращает ключ для сессии"""
+    key = key or uuid.uuid4().hex
+    with engines_lock:
+        engines[key] = {'engine': eng, 'last_used': time.monotonic(), 'verified': time.monotonic(),
+                        'max_overflow': ENGINE_MAX_OVERFLOW}
+    return key
+
+def release_engine(key):
+    """Закрывает движок сессии и все его соединения"""
+    with engines_lock:
+        entry = engines.pop(key, None)
+    if entry:
+        entry['engine'].dispose()
+
+def evict_idle_engines():
+    """Закрывает движки, которыми давно не пользовались (не чаще раза в минуту)"""
+    global engines_last_eviction
+    
+    now = time.monotonic()
+    if now - engines_last_eviction < 60:
+        return
+    engines_last_eviction = now
+    
+    with engines_lock:
+        idle = [key for key, entry in engines.items() if now - entry['last_used'] > ENGINE_IDLE_TIMEOUT]
+        evicted = [engines.pop(key) for key in idle]
+    for entry in evicted:
+        entry['engine'].dispose()
+    if evicted:
+        logger.info(f"Disposed {len(evicted)} idle engine(s)")
+
+def credentials_cipher():
+    """Шифр для данных подключения в хранилище сессий (ключ выводится из ключа сессий)"""
+    digest = hashlib.sha256(f"orex-credentials:{orex.secret_key}".encode('utf-8')).digest()
+    return Fernet(base64.urlsafe_b64encode(digest))
+
+class CredentialStore:
+    """Данные подключения сессий в файле SQLite, по случайному ключу из cookie.
+    
+    В cookie только ключ: после выхода запись удаляется, и скопированная раньше
+    cookie уже ни к чему не подключается. Файл общий для воркеров - сессия,
+    пришедшая в другой воркер, пересоздает движок отсюда.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions "
+                         "(key TEXT PRIMARY KEY, credentials BLOB NOT NULL, expires REAL NOT NULL)")
+        os.chmod(path, 0o600)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def put(self, key, credentials):
+        payload = credentials_cipher().encrypt(json.dumps(credentials).encode('utf-8'))
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+            conn.execute("INSERT OR REPLACE INTO sessions (key, credentials, expires) VALUES (?, ?, ?)",
+                         (key, payload, now + SESSION_IDLE_TIMEOUT))
+
+    def get(self, key):
+        """Данные подключения или None (вышли, истекла или ключ подделан); продлевает срок"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT credentials, expires FROM sessions WHERE key = ? AND expires > ?",
+                               (key, now)).fetchone()
+            if row is None:
+                return None
+            # Продлеваем не чаще раза в минуту, чтобы не писать в файл на каждый запрос
+            if row[1] < now + SESSION_IDLE_TIMEOUT - 60:
+                conn.execute("UPDATE sessions SET expires = ? WHERE key = ?", (now + SESSION_IDLE_TIMEOUT, key))
+        try:
+            return json.loads(credentials_cipher().decrypt(row[0]))
+        except InvalidToken:
+            return None
+
+    def delete(self, key):
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+credential_store = None
+credential_store_lock = threading.Lock()
+
+def get_credential_store():
+    """Хранилище создается при первом обращении (в рабочей папке, как security-файлы)"""
+    global credential_store
+    with credential_store_lock:
+        if credential_store is None:
+            credential_store = CredentialStore(CREDENTIALS_STORE)
+        return credential_store
+
+def forget_session_engine(key):
+    """Выход: удаляет данные подключения сессии и закрывает ее движок в этом воркере.
+    Другие воркеры закроют свой при следующем запросе с этим ключом"""
+    if key:
+        get_credential_store().delete(key)
+        release_engine(key)
+
+def get_engine():
+    """Движок текущей сессии или None, если его нет (не вошли, вышли или сессия истекла).
+    
+    Движок берется из памяти процесса; с хранилищем сессий он сверяется не чаще
+    раза в SESSION_RECHECK_INTERVAL - после выхода в другом воркере движок здесь
+    закрывается не позже чем через этот интервал (в воркере выхода - сразу).
+    Если сессия пришла в другой воркер или движок закрыт по простою, он
+    пересоздается из данных подключения в хранилище.
+    """
+    evict_idle_engines()
+    key = session.get('engine_key')
+    if not key:
+        return None
+    
+    now = time.monotonic()
+    with engines_lock:
+        entry = engines.get(key)
+        if entry is not None:
+            entry['last_used'] = now
+            if now - entry['verified'] < SESSION_RECHECK_INTERVAL:
+                return entry['engine']
+    
+    credentials = get_credential_store().get(key)
+    if credentials is None:
+        release_engine(key)
+        return None
+    
+    if entry is not None:
+        entry['verified'] = now
+        return entry['engine']
+    
+    engine = create_user_engine(*credentials)
+    with engines_lock:
+        # Параллельный запрос той же сессии мог успеть раньше
+        entry = engines.setdefault(key, {'engine': engine, 'last_used': now, 'verified': now,
+                                         'max_overflow': ENGINE_MAX_OVERFLOW})
+    if entry['engine'] is not engine:
+        engine.dispose()
+    return entry['engine']
+
+# Метрики для Prometheus (/orex-ws/metrics). Каждое событие - пара операций со
+# словарем под блокировкой, поэтому метрики включены всегда. Воркеры gunicorn
+# раз в METRICS_FLUSH_INTERVAL сбрасывают свои значения в METRICS_DIR (в памяти,
+# не на SD-карте), ответ /metrics складывает значения всех живых воркеров
+class Metrics:
+    """Счетчики, гистограммы и показатели процесса: (имя, метки) -> значение"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}  # Значение - счетчики по METRICS_BUCKETS, +Inf, затем сумма
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        position = bisect.bisect_left(METRICS_BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(METRICS_BUCKETS) + 2)
+            histogram[position] += 1
+            histogram[-1] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, list(values)] for (name, labels), values in self.histograms.items()],
+                'gauges': [[name, labels, value] for (name, labels), value in pool_gauges().items()],
+            }
+
+metrics = Metrics()
+metrics_last_flush = 0.0
+
+METRICS_HELP = {
+    'orex_http_requests_total': ('counter', 'Ответы по маршрутам и кодам'),
+    'orex_http_request_duration_seconds': ('histogram', 'Время запроса до конца отдачи ответа'),
+    'orex_sql_queries_total': ('counter', 'SQL-запросы по виду'),
+    'orex_sql_query_duration_seconds': ('histogram', 'Время выполнения SQL-запроса'),
+    'orex_sql_rows_total': ('counter', 'Строки, измененные или выбранные запросами (если драйвер их знает)'),
+    'orex_sql_errors_total': ('counter', 'SQL-запросы с ошибкой'),
+    'orex_odt_stage_duration_seconds': ('histogram', 'Этапы генерации документа по шаблону'),
+    'orex_security_list_reads_total': ('counter', 'Чтения security-файлов с диска (full - целиком, tail - дописанные строки)'),
+    'orex_db_engines': ('gauge', 'Открытые движки БД (по одному на сессию)'),
+    'orex_db_pool_checked_out': ('gauge', 'Соединения, занятые запросами'),
+    'orex_db_pool_idle': ('gauge', 'Свободные соединения в пулах'),
+    'orex_db_pool_overflow': ('gauge', 'Соединения сверх pool_size'),
+    'orex_db_pool_capacity': ('gauge', 'Максимум соединений во всех пулах (pool_size + max_overflow)'),
+}
+
+SQL_STATEMENT_KINDS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'SHOW', 'CHECKSUM', 'CREATE', 'ALTER', 'DROP'}
+
+def sql_statement_kind(statement):
+    kind = statement.lstrip()[:9].split(None, 1)
+    kind = kind[0].upper() if kind else ''
+    return kind if kind in SQL_STATEMENT_KINDS else 'OTHER'
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query_metrics(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    labels = (('statement', sql_statement_kind(statement)),)
+    metrics.observe('orex_sql_query_duration_seconds', labels, time.perf_counter() - started)
+    metrics.inc('orex_sql_queries_total', labels)
+    # Серверный курсор (выгрузка таблиц) число строк заранее не знает
+    if 0 < cursor.rowcount < 2 ** 63:
+        metrics.inc('orex_sql_rows_total', labels, cursor.rowcount)
+
+@event.listens_for(Engine, 'handle_error')
+def record_query_error(context):
+    started = context.connection.info.get('query_started') if context.connection is not None else None
+    if started:
+        started.pop()
+    metrics.inc('orex_sql_errors_total', (('statement', sql_statement_kind(context.statement or '')),))
+
+def pool_gauges():
+    """Пулы соединений всех движков процесса (сумма по пользователям)"""
+    with engines_lock:
+        pools = [(entry['engine'].pool, entry['max_overflow']) for entry in engines.values()]
+    gauges = {('orex_db_engines', ()): len(pools)}
+    for name in ('orex_db_pool_checked_out', 'orex_db_pool_idle', 'orex_db_pool_overflow', 'orex_db_pool_capacity'):
+        gauges[(name, ())] = 0
+    for pool, max_overflow in pools:
+        if not isinstance(pool, QueuePool):
+            continue
+        gauges[('orex_db_pool_checked_out', ())] += pool.checkedout()
+        gauges[('orex_db_pool_idle', ())] += pool.checkedin()
+        gauges[('orex_db_pool_overflow', ())] += max(pool.overflow(), 0)
+        gauges[('orex_db_pool_capacity', ())] += pool.size() + max_overflow
+    return gauges
+
+def flush_metrics(force=False):
+    """Сбрасывает метрики процесса в файл METRICS_DIR/<pid>.json (не чаще METRICS_FLUSH_INTERVAL)"""
+    global metrics_last_flush
+    now = time.monotonic()
+    if not force and now - metrics_last_flush < METRICS_FLUSH_INTERVAL:
+        return
+    metrics_last_flush = now
+    
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(metrics.snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+def read_metrics_file(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def add_metrics(counters, histograms, snapshot, gauges=None):
+    """Прибавляет снимок метрик к суммам; показатели - только если передан gauges"""
+    parts = [(counters, snapshot['counters'])]
+    if gauges is not None:
+        parts.append((gauges, snapshot.get('gauges', [])))
+    for target, items in parts:
+        for name, labels, value in items:
+            key = (name, tuple(map(tuple, labels)))
+            target[key] = target.get(key, 0) + value
+    for name, labels, values in snapshot['histograms']:
+        key = (name, tuple(map(tuple, labels)))
+        total = histograms.setdefault(key, [0] * len(values))
+        for i, value in enumerate(values):
+            total[i] += value
+
+def archive_dead_workers():
+    """Переносит счетчики и гистограммы завершившихся воркеров в METRICS_ARCHIVE и удаляет их файлы.
+    
+    Иначе после перезапуска воркера gunicorn суммы *_total уменьшались бы. Показатели
+    (пулы соединений) умершего воркера просто отбрасываются.
+    """
+    dead = []
+    for entry in os.scandir(METRICS_DIR):
+        pid, ext = os.path.splitext(entry.name)
+        if ext == '.json' and pid.isdigit() and not process_alive(int(pid)):
+            dead.append(entry.path)
+    if not dead:
+        return
+    
+    archive_path = os.path.join(METRICS_DIR, METRICS_ARCHIVE)
+    with open(archive_path + '.lock', 'w') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        counters, histograms = {}, {}
+        archive = read_metrics_file(archive_path)
+        if archive is not None:
+            add_metrics(counters, histograms, archive)
+        archived = 0
+        for path in dead:
+            # Другой воркер мог перенести этот файл, пока мы ждали блокировку
+            snapshot = read_metrics_file(path)
+            if snapshot is not None:
+                add_metrics(counters, histograms, snapshot)
+                archived += 1
+        if archived:
+            with open(archive_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({
+                    'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                    'histograms': [[name, labels, values] for (name, labels), values in histograms.items()],
+                }, f)
+            os.replace(archive_path + '.tmp', archive_path)
+        for path in dead:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def collect_metrics():
+    """Сумма метрик живых воркеров и архива завершившихся"""
+    flush_metrics(force=True)
+    archive_dead_workers()
+    counters, histograms, gauges = {}, {}, {}
+    archive = read_metrics_file(os.path.join(METRICS_DIR, METRICS_ARCHIVE))
+    if archive is not None:
+        add_metrics(counters, histograms, archive)
+    for entry in os.scandir(METRICS_DIR):
+        pid, ext = os.path.splitext(entry.name)
+        if ext != '.json' or not pid.isdigit():
+            continue
+        snapshot = read_metrics_file(entry.path)
+        if snapshot is not None:
+            add_metrics(counters, histograms, snapshot, gauges)
+    return counters, histograms, gauges
+
+def metric_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+def render_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    counters, histograms, gauges = collect_metrics()
+    lines = []
+    for name, (kind, help_text) in METRICS_HELP.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'histogram':
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(METRICS_BUCKETS + ('+Inf',), values[:-1]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{metric_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{metric_labels(labels)} {values[-1]:.6f}')
+                lines.append(f'{name}_count{metric_labels(labels)} {cumulative}')
+        else:
+            for (metric, labels), value in sorted((counters if kind == 'counter' else gauges).items()):
+                if metric == name:
+                    lines.append(f'{name}{metric_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+@orex.before_request
+def start_request_timer():
+    # Регистрируется раньше проверки безопасности: замеряются и отказы
+    g.request_started = time.perf_counter()
+
+@orex.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        labels = (('route', request.url_rule.rule if request.url_rule else 'unmatched'), ('method', request.method))
+        status_labels = labels + (('status', str(response.status_code)),)
+        
+        # Потоковые ответы (таблицы, выгрузки) считаются до конца отдачи
+        def record():
+            metrics.observe('orex_http_request_duration_seconds', labels, time.perf_counter() - started)
+            metrics.inc('orex_http_requests_total', status_labels)
+            flush_metrics()
+        response.call_on_close(record)
+    return response
+
 # Функции безопасности
 def get_remote_address():
     """Получает реальный IP-адрес клиента за прокси"""
@@ -65,36 +752,213 @@ def read_security_list(filename):
             f.write("# Security list\n")
         return []
 
+class SecurityList:
+    """Security-лист в памяти с индексами по IP и по паре (IP, отпечаток).
+
+    Файл читается один раз, дальше перечитывается только при изменении
+    mtime/размера: если файл дописан - разбирается только хвост, иначе файл
+    разбирается целиком. Дописан - значит тот же inode и прежнее начало файла
+    (sha1 уже прочитанной части): правка в середине ведет к полной перезагрузке.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.ips = set()
+        self.pairs = set()
+        self.mtime = None
+        self.size = 0
+        self.inode = None
+        self.digest = None  # sha1 прочитанных self.size байт
+
+    def _add_line(self, line):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return
+        parts = line.split('|')
+        ip = parts[0].strip()
+        fingerprint = parts[1].strip() if len(parts) > 1 else ''
+        self.ips.add(ip)
+        self.pairs.add((ip, fingerprint))
+
+    def _refresh(self):
+        """Синхронизирует индексы с файлом (вызывается под блокировкой)"""
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            read_security_list(self.filename)  # создаст пустой файл
+            stat = os.stat(self.filename)
+        
+        if stat.st_mtime == self.mtime and stat.st_size == self.size:
+            return
+        
+        with open(self.filename, 'rb') as f:
+            content = f.read()
+        
+        # Дописан, только если начало файла не изменилось; иначе (первая загрузка,
+        # файл перезаписан или поправлен в середине) разбираем целиком
+        offset = self.size
+        if (self.mtime is None or stat.st_ino != self.inode or len(content) < offset
+                or hashlib.sha1(content[:offset]).hexdigest() != self.digest):
+            self.ips = set()
+            self.pairs = set()
+            offset = 0
+        metrics.inc('orex_security_list_reads_total',
+                    (('list', os.path.basename(self.filename)), ('mode', 'tail' if offset else 'full')))
+        
+        # Неполную последнюю строку оставляем до следующего раза
+        end = content.rfind(b'\n') + 1
+        if end > offset:
+            for line in content[offset:end].decode('utf-8', errors='replace').splitlines():
+                self._add_line(line)
+        else:
+            end = offset
+        
+        self.mtime = stat.st_mtime
+        self.inode = stat.st_ino
+        self.size = end
+        self.digest = hashlib.sha1(content[:end]).hexdigest()
+
+    def has_ip(self, ip):
+        with self.lock:
+            self._refresh()
+            return ip in self.ips
+
+    def has_pair(self, ip, fingerprint):
+        with self.lock:
+            self._refresh()
+            return (ip, fingerprint) in self.pairs
+
+    def append(self, ip, value, unique_ip=False):
+        """Дописывает запись в файл и сразу в индексы.
+        
+        С unique_ip запись не делается, если IP уже есть в списке (в том числе
+        дописанный другим воркером) - серия запросов не пишет одно и то же много раз.
+        """
+        with self.lock:
+            self._refresh()
+            if unique_ip and ip in self.ips:
+                return False
+            with open(self.filename, 'a', encoding='utf-8') as f:
+                f.write(f"{ip}|{value}|{datetime.now()}\n")
+            self.ips.add(ip)
+            self.pairs.add((ip, value))
+            return True
+
+# Загружаются лениво при первой проверке
+whitelist_store = SecurityList(SECURITY_WHITELIST)
+blacklist_store = SecurityList(SECURITY_BLACKLIST)
+
 def is_ip_banned(ip):
     """Проверяет, забанен ли IP"""
-    blacklist = read_security_list(SECURITY_BLACKLIST)
-    return any(ip in entry for entry in blacklist)
+    return blacklist_store.has_ip(ip)
 
 def add_to_blacklist(ip, reason="Multiple failed attempts"):
-    """Добавляет в черный список"""
-    with open(SECURITY_BLACKLIST, 'a', encoding='utf-8') as f:
-        f.write(f"{ip}|{reason}|{datetime.now()}\n")
+    """Добавляет в черный список (если IP там еще нет)"""
+    blacklist_store.append(ip, reason, unique_ip=True)
 
 def add_to_whitelist(ip, fingerprint):
     """Добавляет в белый список"""
-    with open(SECURITY_WHITELIST, 'a', encoding='utf-8') as f:
-        f.write(f"{ip}|{fingerprint}|{datetime.now()}\n")
+    whitelist_store.append(ip, fingerprint)
 
 def check_whitelist(ip, fingerprint):
     """Проверяет, есть ли IP и отпечаток в белом списке"""
-    whitelist = read_security_list(SECURITY_WHITELIST)
-    return any(ip in entry and fingerprint in entry for entry in whitelist)
+    return whitelist_store.has_pair(ip, fingerprint)
+
+def is_ip_whitelisted(ip):
+    """Проверяет, есть ли IP в белом списке (с любым отпечатком)"""
+    return whitelist_store.has_ip(ip)
 
 def log_login_attempt(ip, fingerprint, success, message=""):
-    """Логирует попытку входа"""
+    """Логирует попытку входа в журнал аудита"""
     short_fingerprint = fingerprint[:10] if fingerprint else "none"
-    status = "Success" if success else f"Failure: {message}"
-    
-    with open(LOGIN_LOG, 'a', encoding='utf-8') as f:
-        f.write(f"[{datetime.now()}] {ip} {short_fingerprint} {status}\n")
+    audit('login', ip=ip, fingerprint=short_fingerprint, success=success, message=message)
+
+# Учет неудачных входов: скользящее окно LOGIN_FAILURE_WINDOW по каждому IP
+class MemoryThrottleStore:
+    """Неудачные входы в памяти процесса; помнит не больше max_keys IP (LRU)"""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.attempts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def failures(self, key, since):
+        with self.lock:
+            times = self.attempts.get(key)
+            return sum(1 for moment in times if moment > since) if times else 0
+
+    def add_failure(self, key, now):
+        with self.lock:
+            times = self.attempts.pop(key, None) or deque(maxlen=LOGIN_MAX_FAILURES)
+            times.append(now)
+            self.attempts[key] = times
+            while len(self.attempts) > self.max_keys:
+                self.attempts.popitem(last=False)
+
+    def reset(self, key):
+        with self.lock:
+            self.attempts.pop(key, None)
 
-# Глобальный словарь для отслеживания попыток входа
-login_attempts = {}
+class SqliteThrottleStore:
+    """Неудачные входы в файле SQLite - счетчики видят все воркеры и они переживают перезапуск"""
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS login_failures (ip TEXT NOT NULL, moment REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS login_failures_ip ON login_failures (ip, moment)")
+            conn.execute("CREATE INDEX IF NOT EXISTS login_failures_moment ON login_failures (moment)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def failures(self, key, since):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM login_failures WHERE ip = ? AND moment > ?",
+                                (key, since)).fetchone()[0]
+
+    def add_failure(self, key, now):
+        with closing(self._connect()) as conn:
+            # Старые записи вне окна больше не нужны - таблица не растет без предела
+            conn.execute("DELETE FROM login_failures WHERE moment <= ?", (now - LOGIN_FAILURE_WINDOW,))
+            conn.execute("INSERT INTO login_failures (ip, moment) VALUES (?, ?)", (key, now))
+
+    def reset(self, key):
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM login_failures WHERE ip = ?", (key,))
+
+def create_throttle_store():
+    """Хранилище неудачных входов по LOGIN_THROTTLE_STORE"""
+    if LOGIN_THROTTLE_STORE == 'memory':
+        return MemoryThrottleStore(LOGIN_THROTTLE_MAX_IPS)
+    try:
+        return SqliteThrottleStore(LOGIN_THROTTLE_STORE)
+    except sqlite3.Error as e:
+        logger.error(f"Login throttle store error, using memory: {str(e)}")
+        return MemoryThrottleStore(LOGIN_THROTTLE_MAX_IPS)
+
+login_throttle = None
+login_throttle_lock = threading.Lock()
+
+def get_login_throttle():
+    """Хранилище создается при первом входе (в рабочей папке, как security-файлы)"""
+    global login_throttle
+    with login_throttle_lock:
+        if login_throttle is None:
+            login_throttle = create_throttle_store()
+        return login_throttle
+
+def login_failures(ip):
+    """Число неудачных входов с IP за последние LOGIN_FAILURE_WINDOW секунд"""
+    return get_login_throttle().failures(ip, time.time() - LOGIN_FAILURE_WINDOW)
+
+def record_login_failure(ip):
+    get_login_throttle().add_failure(ip, time.time())
+
+def reset_login_failures(ip):
+    get_login_throttle().reset(ip)
 
 @orex.before_request
 def security_check():
@@ -103,14 +967,19 @@ def security_check():
     if request.headers.get('X-Forwarded-Proto') == 'https':
         request.environ['wsgi.url_scheme'] = 'https'
     
-    # Пропускаем статические файлы и страницу логина
-    if request.endpoint in ['login', 'static']:
+    # Пропускаем статические файлы, страницу логина и метрики (проверяются в самом маршруте)
+    if request.endpoint in ['login', 'static', 'metrics_endpoint']:
         return
     
     # Проверяем авторизацию
     if not session.get('logged_in'):
         return redirect(url_for('login'))
     
+    # Движок мог быть закрыт по простою или после перезапуска сервера
+    if get_engine() is None:
+        session.clear()
+        return redirect(url_for('login'))
+    
     # Проверяем безопасность
     ip = get_remote_address()
     user_agent = request.user_agent.string
@@ -130,50 +999,142 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Функция для получения метаданных таблицы
-def get_table_metadata(table_name):
+# Функция для чтения метаданных таблицы из БД
+def load_table_metadata(inspector, table_name):
     """Получаем детальную информацию о колонках таблицы"""
+    columns = []
+    
+    for col in inspector.get_columns(table_name):
+        # Определяем тип данных
+        col_type = str(col['type'])
+        if 'INT' in col_type:
+            data_type = 'INTEGER'
+        elif 'VARCHAR' in col_type or 'TEXT' in col_type:
+            data_type = 'TEXT'
+        elif 'DATE' in col_type:
+            data_type = 'DATE'
+        elif 'DATETIME' in col_type or 'TIMESTAMP' in col_type:
+            data_type = 'DATETIME'
+        elif 'BOOLEAN' in col_type:
+            data_type = 'BOOLEAN'
+        else:
+            data_type = col_type
+        
+        # Форматируем значение по умолчанию
+        default_value = col.get('default')
+        if isinstance(default_value, str) and default_value.startswith("'") and default_value.endswith("'"):
+            default_value = default_value[1:-1]
+        
+        column_info = {
+            'name': col['name'],
+            'type': data_type,
+            'nullable': col['nullable'],
+            'default': default_value,
+            'autoincrement': col.get('autoincrement', False),
+            'primary_key': col.get('primary_key', False)
+        }
+        columns.append(column_info)
+    
+    return columns
+
+# Кэш структуры таблиц: (БД, таблица) -> колонки, первичный ключ, время загрузки.
+# Структура меняется только через Adminer, поэтому не перечитываем ее на каждый запрос
+schema_cache = {}
+schema_cache_lock = threading.Lock()
+
+def schema_cache_key(eng):
+    """Ключ кэша для движка - адрес БД без пароля"""
+    return eng.url.render_as_string(hide_password=True)
+
+def get_table_create_time(eng, table_name):
+    """CREATE_TIME таблицы в MariaDB/MySQL (меняется при ALTER TABLE), для остальных БД None"""
+    if eng.dialect.name not in ('mysql', 'mariadb'):
+        return None
+    with eng.connect() as conn:
+        return conn.execute(
+            text("SELECT CREATE_TIME FROM information_schema.TABLES "
+                 "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name"),
+            {'name': table_name}
+        ).scalar()
+
+def get_table_schema(table_name):
+    """Структура таблицы из кэша: колонки с типами, первичный ключ.
+    
+    Запись живет SCHEMA_CACHE_TTL секунд. После этого, если включен
+    SCHEMA_CHECK_CREATE_TIME, сначала сверяется CREATE_TIME таблицы, и полное
+    чтение через inspector делается только если таблица изменилась.
+    """
+    engine = get_engine()
+    key = (schema_cache_key(engine), table_name)
+    now = time.monotonic()
+    
+    with schema_cache_lock:
+        entry = schema_cache.get(key)
+    
+    if entry and now - entry['loaded'] < SCHEMA_CACHE_TTL:
+        return entry
+    
     try:
+        create_time = get_table_create_time(engine, table_name) if SCHEMA_CHECK_CREATE_TIME else None
+        
+        if entry and create_time is not None and create_time == entry['create_time']:
+            # Таблица не менялась - продлеваем запись без повторной интроспекции
+            entry['loaded'] = now
+            return entry
+        
         inspector = inspect(engine)
-        columns = []
-        
-        for col in inspector.get_columns(table_name):
-            # Определяем тип данных
-            col_type = str(col['type'])
-            if 'INT' in col_type:
-                data_type = 'INTEGER'
-            elif 'VARCHAR' in col_type or 'TEXT' in col_type:
-                data_type = 'TEXT'
-            elif 'DATE' in col_type:
-                data_type = 'DATE'
-            elif 'DATETIME' in col_type or 'TIMESTAMP' in col_type:
-                data_type = 'DATETIME'
-            elif 'BOOLEAN' in col_type:
-                data_type = 'BOOLEAN'
-            else:
-                data_type = col_type
-            
-            # Форматируем значение по умолчанию
-            default_value = col.get('default')
-            if isinstance(default_value, str) and default_value.startswith("'") and default_value.endswith("'"):
-                default_value = default_value[1:-1]
-            
-            column_info = {
-                'name': col['name'],
-                'type': data_type,
-                'nullable': col['nullable'],
-                'default': default_value,
-                'autoincrement': col.get('autoincrement', False),
-                'primary_key': col.get('primary_key', False)
-            }
-            columns.append(column_info)
+        columns = load_table_metadata(inspector, table_name)
+        primary_keys = inspector.get_pk_constraint(table_name)['constrained_columns']
+        
+        # FULLTEXT-индексы MariaDB (берем самый широкий) - для поиска по таблице
+        fulltext_indexes = [index['column_names'] for index in inspector.get_indexes(table_name)
+                            if index.get('dialect_options', {}).get('mysql_prefix') == 'FULLTEXT']
         
-        return columns
+        entry = {
+            'columns': columns,
+            'column_names': [col['name'] for col in columns],
+            'primary_key': primary_keys[0] if primary_keys else None,
+            'fulltext': max(fulltext_indexes, key=len) if fulltext_indexes else None,
+            'create_time': create_time,
+            'loaded': now
+        }
+        with schema_cache_lock:
+            schema_cache[key] = entry
+        return entry
     
     except Exception as e:
         logger.error(f"Error getting metadata for {table_name}: {str(e)}")
         raise
 
+def get_table_metadata(table_name):
+    """Получаем детальную информацию о колонках таблицы"""
+    return get_table_schema(table_name)['columns']
+
+def get_table_names():
+    """Список таблиц БД (кэшируется так же, как структура таблиц)"""
+    engine = get_engine()
+    key = (schema_cache_key(engine), None)
+    now = time.monotonic()
+    
+    with schema_cache_lock:
+        entry = schema_cache.get(key)
+    
+    if entry and now - entry['loaded'] < SCHEMA_CACHE_TTL:
+        return entry['tables']
+    
+    entry = {'tables': inspect(engine).get_table_names(), 'loaded': now}
+    with schema_cache_lock:
+        schema_cache[key] = entry
+    return entry['tables']
+
+def invalidate_schema_cache(table_name=None):
+    """Сбрасывает кэш структуры для текущей БД (одной таблицы или всех)"""
+    db_key = schema_cache_key(get_engine())
+    with schema_cache_lock:
+        for key in list(schema_cache):
+            if key[0] == db_key and (table_name is None or key[1] in (table_name, None)):
+                del schema_cache[key]
+
 # Функция для получения списка шаблонов
 def get_template_list():
     """Возвращает список доступных шаблонов"""
@@ -183,112 +1144,2368 @@ def get_template_list():
         logger.error(f"Error listing templates: {str(e)}")
         return []
 
-# Функция для обработки шаблона
-def process_odt_template(template_path, data):
-    """Обрабатывает ODT шаблон, подставляя данные"""
-    # Создаем временную папку для работы
-    temp_dir = tempfile.mkdtemp()
-    logger.debug(f"Created temp directory: {temp_dir}")
-    
-    try:
-        # Распаковываем ODT файл (это ZIP архив)
-        with zipfile.ZipFile(template_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        
-        # Основной контент находится в content.xml
-        content_path = os.path.join(temp_dir, 'content.xml')
-        
-        # Читаем и парсим XML
-        tree = ET.parse(content_path)
-        root = tree.getroot()
-        
-        # Создаем словарь замен
-        replacements = {f'${key}': str(value) for key, value in data.items()}
-        
-        # Функция для рекурсивной замены в элементах
-        def replace_in_element(elem, reps):
-            # Обрабатываем текст элемента
-            if elem.text:
-                for ph, value in reps.items():
-                    if ph in elem.text:
-                        logger.debug(f"Replacing {ph} with {value}")
-                        elem.text = elem.text.replace(ph, value)
-            
-            # Обрабатываем tail элемента
-            if elem.tail:
-                for ph, value in reps.items():
-                    if ph in elem.tail:
-                        elem.tail = elem.tail.replace(ph, value)
+# Разбор XML на разметку и текст: теги (с учетом кавычек в атрибутах) и текст между ними
+XML_TAG_RE = re.compile(r"""(<(?:[^>"']|"[^"]*"|'[^']*')*>)""")
+
+# Части ODT, в которых подставляются данные (текст, колонтитулы)
+ODT_DYNAMIC_MEMBERS = ('content.xml', 'styles.xml')
+
+# Начало плейсхолдера в конце текстового узла: '$', '$Ном', '${Ном'
+PLACEHOLDER_TAIL_RE = re.compile(r'\$(?:\{[^}]*|\w*)$')
+# Теги, которыми LibreOffice может разрезать плейсхолдер при правке форматирования
+PLACEHOLDER_SPLIT_TAG_RE = re.compile(r'</?text:span\b')
+
+def merge_split_placeholders(tokens):
+    """Собирает плейсхолдеры, разрезанные на несколько <text:span>, в один текстовый узел.
+    
+    tokens - результат XML_TAG_RE.split: на четных местах текст, на нечетных теги.
+    Продолжение плейсхолдера переносится из следующих узлов в узел с '$'.
+    """
+    for i in range(0, len(tokens), 2):
+        tail = PLACEHOLDER_TAIL_RE.search(tokens[i])
+        if not tail:
+            continue
+        
+        braced = tail.group().startswith('${')
+        continuation = re.compile(r'[^}]*\}?' if braced else r'\w*')
+        j = i + 1
+        while j + 1 < len(tokens) and PLACEHOLDER_SPLIT_TAG_RE.match(tokens[j]):
+            following = tokens[j + 1]
+            part = continuation.match(following).group()
+            if not part and following:
+                break
             
-            # Рекурсивно обрабатываем дочерние элементы
-            for child in elem:
-                replace_in_element(child, reps)
+            tokens[i] += part
+            tokens[j + 1] = following[len(part):]
+            if len(part) < len(following) or (braced and part.endswith('}')):
+                break
+            j += 2
+    return tokens
+
+# Любой плейсхолдер в тексте: ${имя} или $имя - для списка колонок, нужных шаблону
+PLACEHOLDER_NAME_RE = re.compile(r'\$(?:\{([^}]*)\}|(\w+))')
+
+@functools.lru_cache(maxsize=64)
+def placeholder_pattern(keys):
+    """Регулярка для всех плейсхолдеров набора колонок: $ключ или ${ключ}.
+    
+    Ключи идут от длинных к коротким, поэтому $id_sender не превратится в
+    значение $id с хвостом '_sender'.
+    """
+    names = '|'.join(re.escape(key) for key in sorted(keys, key=len, reverse=True))
+    return re.compile(rf'\$(?:\{{({names})\}}|({names})(?!\w))')
+
+class CompiledXml:
+    """XML-часть шаблона, заранее разбитая на неизменный текст и текстовые узлы с плейсхолдерами.
+    
+    В parts на четных местах - готовые куски XML, на нечетных - текстовые
+    узлы (уже экранированные), в которых встречается '$'.
+    """
+
+    def __init__(self, xml):
+        self.parts = ['']
+        tokens = merge_split_placeholders(XML_TAG_RE.split(xml))
+        for i, token in enumerate(tokens):
+            if i % 2 == 0 and '$' in token:
+                self.parts.append(token)
+                self.parts.append('')
+            else:
+                self.parts[-1] += token
+        
+        self.placeholders = {xml_unescape(match.group(1) or match.group(2))
+                             for part in self.parts[1::2] for match in PLACEHOLDER_NAME_RE.finditer(part)}
+
+    @property
+    def has_placeholders(self):
+        return len(self.parts) > 1
+
+    def render(self, pattern, values):
+        """Подстановка за один проход регулярки по каждому текстовому узлу"""
+        replace = lambda match: values[match.group(1) or match.group(2)]
+        result = list(self.parts)
+        for i in range(1, len(result), 2):
+            result[i] = pattern.sub(replace, result[i])
+        return ''.join(result)
+
+class CompiledOdtTemplate:
+    """ODT-шаблон, разобранный один раз.
+    
+    Неизменяемые части архива (картинки, стили, манифест) хранятся как
+    готовые сжатые байты и при сборке документа копируются без пересжатия.
+    Пересжимаются только части с подставленными данными.
+    """
+
+    def __init__(self, template_path):
+        self.members = []
+        self.placeholders = set()  # Имена из $имя / ${имя} во всех частях шаблона
+        started = time.perf_counter()
+        parse_time = 0.0
         
-        # Выполняем замену во всем дереве XML
-        replace_in_element(root, replacements)
+        with open(template_path, 'rb') as f:
+            # Хэш содержимого - часть ключа кэша готовых документов
+            self.digest = hashlib.sha256(f.read()).hexdigest()
+            f.seek(0)
+            with zipfile.ZipFile(f) as archive:
+                for info in archive.infolist():
+                    if info.filename in ODT_DYNAMIC_MEMBERS:
+                        xml = archive.read(info).decode('utf-8')
+                        parse_started = time.perf_counter()
+                        compiled = CompiledXml(xml)
+                        parse_time += time.perf_counter() - parse_started
+                        if compiled.has_placeholders:
+                            self.members.append((info, compiled))
+                            self.placeholders |= compiled.placeholders
+                            continue
+                    self.members.append((info, read_raw_zip_member(f, info)))
         
-        # Сохраняем изменения
-        tree.write(content_path, encoding='utf-8', xml_declaration=True)
+        metrics.observe('orex_odt_stage_duration_seconds', (('stage', 'unzip'),),
+                        time.perf_counter() - started - parse_time)
+        metrics.observe('orex_odt_stage_duration_seconds', (('stage', 'parse'),), parse_time)
+
+    def render(self, data):
+        """Собирает документ в памяти, возвращает байты ODT"""
+        # Сравниваем с уже экранированным текстом XML, поэтому экранируем и ключи
+        values = {xml_escape(str(key)): xml_escape(str(value)) for key, value in data.items()}
+        pattern = placeholder_pattern(tuple(sorted(values)))
         
-        # Собираем обратно в ODT
-        processed_path = os.path.join(temp_dir, 'processed.odt')
-        with zipfile.ZipFile(processed_path, 'w') as zip_ref:
-            for folder, _, files in os.walk(temp_dir):
-                for file in files:
-                    if file != 'processed.odt':  # Не включаем сам файл архива
-                        file_path = os.path.join(folder, file)
-                        arc_path = os.path.relpath(file_path, temp_dir)
-                        zip_ref.write(file_path, arc_path)
+        output = io.BytesIO()
+        entries = []
+        started = time.perf_counter()
+        substitute_time = 0.0
+        for info, member in self.members:
+            if isinstance(member, CompiledXml):
+                substitute_started = time.perf_counter()
+                content = member.render(pattern, values).encode('utf-8')
+                substitute_time += time.perf_counter() - substitute_started
+                compressor = zlib.compressobj(ODT_COMPRESS_LEVEL, zlib.DEFLATED, -15)
+                raw = compressor.compress(content) + compressor.flush()
+                entry = (info, zipfile.ZIP_DEFLATED, zlib.crc32(content), len(content), raw)
+            else:
+                entry = (info, info.compress_type, info.CRC, info.file_size, member)
+            entries.append(write_zip_entry(output, *entry))
+        write_zip_central_directory(output, entries)
         
-        return processed_path, temp_dir
+        metrics.observe('orex_odt_stage_duration_seconds', (('stage', 'substitute'),), substitute_time)
+        metrics.observe('orex_odt_stage_duration_seconds', (('stage', 'zip'),),
+                        time.perf_counter() - started - substitute_time)
+        return output.getvalue()
+
+def read_raw_zip_member(f, info):
+    """Сжатые байты части архива как есть, без распаковки"""
+    f.seek(info.header_offset)
+    header = f.read(30)
+    name_length, extra_length = struct.unpack('<2H', header[26:30])
+    f.seek(info.header_offset + 30 + name_length + extra_length)
+    return f.read(info.compress_size)
+
+def dos_date_time(date_time):
+    """Дата и время в формате ZIP (MS-DOS)"""
+    year, month, day, hour, minute, second = date_time
+    return ((hour << 11) | (minute << 5) | (second // 2),
+            ((year - 1980) << 9) | (month << 5) | day)
+
+def write_zip_entry(output, info, compress_type, crc, file_size, raw):
+    """Пишет локальный заголовок и уже сжатые данные, возвращает запись для центрального каталога"""
+    name = info.filename.encode('utf-8')
+    flags = 0x800  # имена в UTF-8; размеры известны заранее, дескриптор данных не нужен
+    dostime, dosdate = dos_date_time(info.date_time)
+    offset = output.tell()
+    
+    output.write(struct.pack('<4s5H3L2H', b'PK\x03\x04', 20, flags, compress_type, dostime, dosdate,
+                             crc, len(raw), file_size, len(name), 0))
+    output.write(name)
+    output.write(raw)
+    return (name, flags, compress_type, dostime, dosdate, crc, len(raw), file_size, info.external_attr, offset)
+
+def write_zip_central_directory(output, entries):
+    """Центральный каталог и конец архива"""
+    start = output.tell()
+    for name, flags, compress_type, dostime, dosdate, crc, compress_size, file_size, external_attr, offset in entries:
+        output.write(struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 20, 20, flags, compress_type, dostime, dosdate,
+                                 crc, compress_size, file_size, len(name), 0, 0, 0, 0, external_attr, offset))
+        output.write(name)
+    size = output.tell() - start
+    output.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, len(entries), len(entries), size, start, 0))
+
+# Кэш разобранных шаблонов: путь -> (mtime, размер, шаблон)
+compiled_templates = {}
+compiled_templates_lock = threading.Lock()
+
+def get_compiled_template(template_path):
+    """Разобранный шаблон из кэша; при изменении файла шаблон разбирается заново"""
+    stat = os.stat(template_path)
+    with compiled_templates_lock:
+        cached = compiled_templates.get(template_path)
+    if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+        return cached[2]
+    
+    compiled = CompiledOdtTemplate(template_path)
+    with compiled_templates_lock:
+        compiled_templates[template_path] = (stat.st_mtime, stat.st_size, compiled)
+    logger.debug(f"Template compiled: {template_path}")
+    return compiled
+
+def forget_compiled_template(template_path):
+    """Убирает шаблон из кэша (при удалении файла)"""
+    with compiled_templates_lock:
+        compiled_templates.pop(template_path, None)
+
+# Общий пул для генерации документов (пакетная генерация)
+document_executor = ThreadPoolExecutor(max_workers=DOCUMENT_WORKERS, thread_name_prefix='orex-doc')
+
+# Функция для обработки шаблона
+def process_odt_template(template_path, data):
+    """Обрабатывает ODT шаблон, подставляя данные; возвращает документ в памяти (BytesIO)"""
+    try:
+        compiled = get_compiled_template(template_path)
+        return io.BytesIO(compiled.render(data))
     
     except Exception as e:
-        shutil.rmtree(temp_dir, ignore_errors=True)
         logger.error(f"Template processing error: {str(e)}")
         raise RuntimeError(f"Ошибка обработки шаблона: {str(e)}")
 
-@orex.route('/orex-ws/login', methods=['GET', 'POST'])
-def login():
-    global engine
-    
-    ip = get_remote_address()
-    user_agent = request.user_agent.string
+# Кэш готовых документов на диске. Ключ - хэш файла шаблона и хэш данных строки,
+# поэтому правка записи или замена шаблона сами дают новый ключ
+class DocumentCache:
+    """Документы в папке по ключу; вытесняются давно не использованные (по mtime файла)"""
+
+    def __init__(self, directory, max_bytes, rescan_puts=DOCUMENT_CACHE_RESCAN_PUTS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rescan_puts = rescan_puts
+        self.size = None  # Размер папки при последнем пересчете плюс свои записи после него
+        self.written = 0  # Записано этим процессом с последнего пересчета
+        self.puts = 0
+        self.lock = threading.Lock()
+
+    def path(self, key, fmt='odt'):
+        return os.path.join(self.directory, f'{key}.{fmt}')
+
+    def get(self, key, fmt='odt'):
+        """Путь к документу или None; попадание обновляет время использования"""
+        path = self.path(key, fmt)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, content, fmt='odt'):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key, fmt)
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+        
+        with self.lock:
+            self.puts += 1
+            self.written += len(content)
+            # Свой счетчик не видит записей других воркеров и задач: папка пересчитывается
+            # каждые rescan_puts записей или после 10% лимита своих записей
+            if (self.size is None or self.puts >= self.rescan_puts
+                    or self.written > self.max_bytes * 0.1):
+                self.size = self._scan()[0]
+                self.puts = self.written = 0
+            else:
+                self.size += len(content)
+            if self.size > self.max_bytes:
+                self._evict()
+        return path
+
+    def _scan(self):
+        """Размер кэша и файлы (время использования, размер, путь); в папку пишут все воркеры"""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(('.odt', '.pdf')):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return sum(file[1] for file in files), files
+
+    def _evict(self):
+        """Удаляет самые давние документы, пока кэш не станет меньше 90% лимита"""
+        total, files = self._scan()
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
+        self.puts = self.written = 0
+
+document_cache = DocumentCache(DOCUMENT_CACHE_DIR, DOCUMENT_CACHE_MAX_BYTES)
+
+def document_cache_key(template_path, data):
+    """Ключ документа в кэше: хэш файла шаблона и данных строки"""
+    values = json.dumps({str(key): str(value) for key, value in data.items()}, sort_keys=True)
+    return hashlib.sha256(f'{get_compiled_template(template_path).digest}:{values}'.encode('utf-8')).hexdigest()
+
+def cached_document(template_path, data, fmt='odt'):
+    """Путь к готовому документу по шаблону и данным; генерируется только при промахе кэша.
     
-    # Проверка безопасности для GET запроса
-    if request.method == 'GET':
-        # Проверяем бан по IP
-        if is_ip_banned(ip):
-            return f"Доступ запрещен: IP заблокирован", 403
+    fmt='pdf' - PDF из того же ODT (ODT тоже остается в кэше).
+    """
+    key = document_cache_key(template_path, data)
+    path = document_cache.get(key, fmt)
+    if path is not None:
+        return path
+    if fmt == 'pdf':
+        odt_path = cached_document(template_path, data)
+        pdf_path = f'{odt_path}.{uuid.uuid4().hex}.pdf'
+        try:
+            get_office_pool().convert(odt_path, pdf_path)
+            with open(pdf_path, 'rb') as f:
+                return document_cache.put(key, f.read(), 'pdf')
+        finally:
+            if os.path.exists(pdf_path):
+                os.remove(pdf_path)
+    return document_cache.put(key, process_odt_template(template_path, data).getvalue())
+
+# PDF через LibreOffice. Запуск soffice на каждый документ на ARM занимает
+# секунды, поэтому процессы soffice держатся запущенными (PDF_WORKERS на воркер
+# gunicorn) и получают документы по UNO через именованный канал. Без python3-uno
+# soffice запускается на каждый документ, но с уже созданным профилем
+def pdf_available():
+    return SOFFICE is not None
+
+def file_url(path):
+    return pathlib.Path(os.path.abspath(path)).as_uri()
+
+def uno_properties(**values):
+    return tuple(PropertyValue(Name=name, Value=value) for name, value in values.items())
+
+def claim_office_profile():
+    """Свободная папка профиля soffice (занятая другим процессом держит flock на .lock)"""
+    os.makedirs(PDF_PROFILE_DIR, exist_ok=True)
+    if fcntl is None:
+        return os.path.join(PDF_PROFILE_DIR, str(os.getpid())), None
+    for number in itertools.count():
+        path = os.path.join(PDF_PROFILE_DIR, str(number))
+        os.makedirs(path, exist_ok=True)
+        lock = open(os.path.join(path, '.lock'), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return path, lock
+        except BlockingIOError:
+            lock.close()
+
+class OfficeProcess:
+    """Один soffice со своим профилем; после падения или зависания запускается заново"""
+
+    def __init__(self, number):
+        self.profile, self.profile_lock = claim_office_profile()
+        self.pipe = f'orex-{os.getpid()}-{number}'
+        self.process = None
+        self.desktop = None
+        self.timed_out = False
+
+    def command(self):
+        return [SOFFICE, '--headless', '--invisible', '--nologo', '--norestore', '--nodefault', '--nolockcheck',
+                f'-env:UserInstallation={file_url(self.profile)}']
+
+    def start(self):
+        self.process = subprocess.Popen(
+            self.command() + [f'--accept=pipe,name={self.pipe};urp;StarOffice.ComponentContext'],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext('com.sun.star.bridge.UnoUrlResolver', local)
+        deadline = time.monotonic() + PDF_START_TIMEOUT
+        while True:
+            try:
+                context = resolver.resolve(f'uno:pipe,name={self.pipe};urp;StarOffice.ComponentContext')
+                break
+            except Exception:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError('LibreOffice не запустился')
+                time.sleep(0.2)
+        self.desktop = context.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', context)
+        logger.info(f"soffice started: pid {self.process.pid}, profile {self.profile}")
+
+    def stop(self):
+        process, self.process, self.desktop = self.process, None, None
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+
+    def kill_hung(self):
+        self.timed_out = True
+        self.stop()
+
+    def convert(self, source, target):
+        """ODT source -> PDF target"""
+        if uno is None:
+            self.convert_once(source, target)
+            return
         
-        # Проверяем браузер
-        if not check_browser_allowed(user_agent):
-            return "Доступ запрещен: Неподдерживаемый браузер", 403
+        if self.process is None or self.process.poll() is not None:
+            self.stop()
+            self.start()
         
-        return render_template('login.html')
-    
-    # Обработка POST запроса
-    fingerprint = request.form.get('fingerprint', '')
+        # Вызовы UNO не прерываются по таймауту - зависший soffice убивает сторожевой таймер
+        self.timed_out = False
+        watchdog = threading.Timer(PDF_TIMEOUT, self.kill_hung)
+        watchdog.start()
+        try:
+            document = self.desktop.loadComponentFromURL(file_url(source), '_blank', 0,
+                                                         uno_properties(Hidden=True, ReadOnly=True))
+            try:
+                document.storeToURL(file_url(target), uno_properties(FilterName='writer_pdf_Export'))
+            finally:
+                document.close(True)
+        except Exception as e:
+            self.stop()
+            if self.timed_out:
+                raise RuntimeError(f'LibreOffice не уложился в {PDF_TIMEOUT} с')
+            raise RuntimeError(f'Ошибка LibreOffice: {str(e)}')
+        finally:
+            watchdog.cancel()
+
+    def convert_once(self, source, target):
+        """Без UNO: отдельный запуск soffice --convert-to на документ"""
+        out_dir = tempfile.mkdtemp(prefix='orex-pdf-')
+        try:
+            subprocess.run(self.command() + ['--convert-to', 'pdf', '--outdir', out_dir, os.path.abspath(source)],
+                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           timeout=PDF_TIMEOUT, check=True)
+            result = os.path.join(out_dir, os.path.splitext(os.path.basename(source))[0] + '.pdf')
+            if not os.path.exists(result):
+                raise RuntimeError('LibreOffice не создал PDF')
+            shutil.move(result, target)
+        except subprocess.TimeoutExpired:
+            raise RuntimeError(f'LibreOffice не уложился в {PDF_TIMEOUT} с')
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(f'Ошибка LibreOffice: {e.stderr.decode("utf-8", errors="replace").strip()}')
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+class OfficePool:
+    """Очередь документов к PDF_WORKERS процессам soffice; процессы запускаются при первом PDF"""
+
+    def __init__(self, size):
+        self.size = size
+        self.idle = queue.Queue()
+        self.processes = []
+        self.lock = threading.Lock()
+
+    def convert(self, source, target):
+        if not pdf_available():
+            raise RuntimeError('LibreOffice (soffice) не установлен - PDF недоступен')
+        with self.lock:
+            if len(self.processes) < self.size and self.idle.empty():
+                office = OfficeProcess(len(self.processes) + 1)
+                self.processes.append(office)
+                self.idle.put(office)
+        
+        started = time.perf_counter()
+        try:
+            office = self.idle.get(timeout=PDF_QUEUE_TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError('LibreOffice занят другими документами, попробуйте позже')
+        metrics.observe('orex_odt_stage_duration_seconds', (('stage', 'pdf_queue'),), time.perf_counter() - started)
+        
+        started = time.perf_counter()
+        try:
+            office.convert(source, target)
+        finally:
+            self.idle.put(office)
+        metrics.observe('orex_odt_stage_duration_seconds', (('stage', 'pdf'),), time.perf_counter() - started)
+
+    def shutdown(self):
+        for office in self.processes:
+            office.stop()
+
+office_pool = None
+office_pool_lock = threading.Lock()
+
+def get_office_pool():
+    global office_pool
+    with office_pool_lock:
+        if office_pool is None:
+            office_pool = OfficePool(PDF_WORKERS)
+            atexit.register(office_pool.shutdown)
+        return office_pool
+
+# Функции для постраничного вывода таблицы
+def get_page_size(value):
+    """Размер страницы из параметра запроса (в допустимых пределах)"""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return TABLE_PAGE_SIZE
+    return max(1, min(size, TABLE_MAX_PAGE_SIZE))
+
+def fetch_rows_page(conn, table_name, primary_key, after, limit, conditions=(), params=None, ids=None):
+    """Keyset-пагинация: строки с первичным ключом больше after.
     
-    # Проверяем бан по IP
-    if is_ip_banned(ip):
-        log_login_attempt(ip, fingerprint, False, "Banned IP")
-        return "Доступ запрещен: IP заблокирован", 403
+    conditions/params - дополнительные условия WHERE (фильтры), ids - ограничение
+    списком первичных ключей (результат поиска по индексу).
+    Возвращает (строки, ключ для следующей страницы или None)
+    """
+    conditions = list(conditions)
+    params = dict(params or {}, limit=limit + 1)
+    if after is not None:
+        conditions.append(f"`{primary_key}` > :after")
+        params['after'] = after
+    if ids is not None:
+        conditions.append(f"`{primary_key}` IN :ids")
+        params['ids'] = ids
     
-    # Проверяем браузер
-    if not check_browser_allowed(user_agent):
-        log_login_attempt(ip, fingerprint, False, "Invalid browser")
-        return "Доступ запрещен: Неподдерживаемый браузер", 403
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    query = text(f"SELECT * FROM `{table_name}` {where} ORDER BY `{primary_key}` LIMIT :limit")
+    if ids is not None:
+        query = query.bindparams(bindparam('ids', expanding=True))
+    rows = [dict(row) for row in conn.execute(query, params).mappings()]
     
-    # Проверяем попытки входа
-    attempt_key = f"{ip}"
-    if attempt_key in login_attempts and login_attempts[attempt_key] >= 3:
-        add_to_blacklist(ip, "Too many failed attempts")
-        log_login_attempt(ip, fingerprint, False, "Too many attempts")
+    # Одна лишняя строка показывает, есть ли что-то дальше
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1][primary_key]
+    return rows, None
+
+def get_max_pk(conn, table_name, primary_key):
+    """Максимальный первичный ключ (удалять можно только последнюю запись)"""
+    return conn.execute(text(f"SELECT MAX(`{primary_key}`) FROM `{table_name}`")).scalar()
+
+def json_value(value):
+    """Приводит значение из БД к виду, пригодному для JSON"""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+def iter_table_rows(engine, table_name, primary_key):
+    """Строки таблицы по одной через серверный курсор (память не растет с размером таблицы)"""
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=STREAM_BATCH_SIZE).execute(
+            text(f"SELECT * FROM `{table_name}` ORDER BY `{primary_key}`"))
+        for row in result.mappings():
+            yield dict(row)
+
+def iter_chunks(parts, size=STREAM_CHUNK_SIZE):
+    """Склеивает мелкие куски потокового ответа в блоки по size байт"""
+    buffer = []
+    buffered = 0
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        buffer.append(part)
+        buffered += len(part)
+        if buffered >= size:
+            yield b''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield b''.join(buffer)
+
+class ZipStreamBuffer:
+    """Файл только для записи: zipfile пишет в него архив, а накопленные байты забираются через pop().
+    
+    Позволяет отдавать ZIP клиенту по мере формирования, не держа весь архив в памяти.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.pending = 0
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.pending += len(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.pending = 0
+        return data
+
+def attachment_headers(filename):
+    """Заголовок Content-Disposition с поддержкой русских имен файлов"""
+    return {'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}"}
+
+def iter_csv_export(columns, rows):
+    """CSV построчно (с BOM, чтобы кириллица открывалась в табличных редакторах)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    buffer.write('\ufeff')
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(['' if row[col] is None else row[col] for col in columns])
+        if buffer.tell() >= STREAM_CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+ODS_MANIFEST = """<?xml version="1.0" encoding="UTF-8"?>
+<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" manifest:version="1.2">
+ <manifest:file-entry manifest:full-path="/" manifest:media-type="application/vnd.oasis.opendocument.spreadsheet"/>
+ <manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>
+</manifest:manifest>
+"""
+
+ODS_CONTENT_HEAD = """<?xml version="1.0" encoding="UTF-8"?>
+<office:document-content xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" office:version="1.2">
+<office:body><office:spreadsheet><table:table table:name="{name}">
+"""
+
+ODS_CONTENT_TAIL = """</table:table></office:spreadsheet></office:body></office:document-content>
+"""
+
+def ods_cell(value):
+    """Ячейка ODS с типом значения"""
+    if value is None:
+        return '<table:table-cell/>'
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, date):  # в том числе datetime
+        return (f'<table:table-cell office:value-type="date" office:date-value="{value.isoformat()}">'
+                f'<text:p>{value}</text:p></table:table-cell>')
+    if isinstance(value, (int, float)):
+        return (f'<table:table-cell office:value-type="float" office:value="{value}">'
+                f'<text:p>{value}</text:p></table:table-cell>')
+    return f'<table:table-cell office:value-type="string"><text:p>{xml_escape(str(value))}</text:p></table:table-cell>'
+
+def iter_ods_export(table_name, columns, rows):
+    """ODS-файл, который собирается и отдается по мере чтения строк"""
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(zipfile.ZipInfo('mimetype'), 'application/vnd.oasis.opendocument.spreadsheet',
+                         compress_type=zipfile.ZIP_STORED)
+        archive.writestr('META-INF/manifest.xml', ODS_MANIFEST)
+        
+        with archive.open('content.xml', 'w') as content:
+            content.write(ODS_CONTENT_HEAD.format(name=xml_escape(table_name, {'"': '&quot;'})).encode('utf-8'))
+            header = ''.join(ods_cell(col) for col in columns)
+            content.write(f'<table:table-row>{header}</table:table-row>\n'.encode('utf-8'))
+            
+            for row in rows:
+                cells = ''.join(ods_cell(row[col]) for col in columns)
+                content.write(f'<table:table-row>{cells}</table:table-row>\n'.encode('utf-8'))
+                if buffer.pending >= STREAM_CHUNK_SIZE:
+                    yield buffer.pop()
+            
+            content.write(ODS_CONTENT_TAIL.encode('utf-8'))
+    yield buffer.pop()
+
+def iter_documents_zip(template_path, rows, primary_key, fmt='odt'):
+    """ZIP с ответами по строкам; документы генерируются в пуле и попадают в архив по мере готовности"""
+    futures = {document_executor.submit(cached_document, template_path, row, fmt): row[primary_key]
+               for row in rows}
+    
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for future in as_completed(futures):
+            row_id = futures[future]
+            # ODT уже сжат, поэтому кладем как есть
+            archive.write(future.result(), f'response_{row_id}.{fmt}',
+                          compress_type=zipfile.ZIP_STORED if fmt == 'odt' else zipfile.ZIP_DEFLATED)
+            yield buffer.pop()
+    yield buffer.pop()
+
+# Фоновые задачи: генерация документов идет вне запроса, клиент опрашивает статус
+# и забирает готовый файл. Состояние лежит в SQLite, поэтому ответить о задаче
+# может любой воркер gunicorn, а файлы - в JOBS_DIR
+class JobStore:
+    """Задачи в файле SQLite: статус, прогресс, путь к результату"""
+
+    FIELDS = ('id', 'kind', 'owner', 'status', 'progress', 'total', 'filename', 'path', 'mimetype',
+              'error', 'pid', 'created', 'finished')
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, owner TEXT, "
+                         "status TEXT, progress INTEGER, total INTEGER, filename TEXT, path TEXT, "
+                         "mimetype TEXT, error TEXT, pid INTEGER, created REAL, finished REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def create(self, job):
+        with closing(self._connect()) as conn:
+            conn.execute(f"INSERT INTO jobs ({', '.join(job)}) VALUES ({', '.join('?' for _ in job)})",
+                         tuple(job.values()))
+
+    def update(self, job_id, **fields):
+        with closing(self._connect()) as conn:
+            conn.execute(f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+                         (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute(f"SELECT {', '.join(self.FIELDS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(zip(self.FIELDS, row)) if row else None
+
+    def pop_expired(self, before):
+        """Удаляет задачи, завершенные раньше before (и брошенные), возвращает их пути к файлам"""
+        with closing(self._connect()) as conn:
+            condition = "finished < ? OR (finished IS NULL AND created < ?)"
+            params = (before, before - JOB_RESULT_TTL)
+            paths = [row[0] for row in conn.execute(f"SELECT path FROM jobs WHERE {condition}", params)]
+            conn.execute(f"DELETE FROM jobs WHERE {condition}", params)
+        return paths
+
+job_store = None
+job_store_lock = threading.Lock()
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='orex-job')
+jobs_last_cleanup = 0.0
+
+def get_job_store():
+    """Хранилище задач создается при первой задаче (в рабочей папке, как security-файлы)"""
+    global job_store
+    with job_store_lock:
+        if job_store is None:
+            job_store = JobStore(JOBS_DB)
+        return job_store
+
+def cleanup_jobs():
+    """Удаляет задачи и файлы старше JOB_RESULT_TTL (не чаще раза в минуту)"""
+    global jobs_last_cleanup
+    now = time.time()
+    with job_store_lock:
+        if now - jobs_last_cleanup < 60:
+            return
+        jobs_last_cleanup = now
+    
+    for path in get_job_store().pop_expired(now - JOB_RESULT_TTL):
+        for filename in (path, path + '.part'):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+def process_alive(pid):
+    """Жив ли процесс (задачи процесса, упавшего или перезапущенного, уже не завершатся)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def submit_job(kind, total, filename, mimetype, func, *args):
+    """Ставит задачу в очередь и сразу возвращает ее id.
+    
+    func(path, report, *args) пишет результат в файл path, report(done) сообщает прогресс.
+    Задача привязана к отпечатку устройства сессии - забрать файл может только он.
+    """
+    cleanup_jobs()
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    job_id = uuid.uuid4().hex
+    job = {
+        'id': job_id, 'kind': kind, 'owner': session.get('fingerprint', ''), 'status': 'queued',
+        'progress': 0, 'total': total, 'filename': filename, 'path': os.path.join(JOBS_DIR, job_id),
+        'mimetype': mimetype, 'pid': os.getpid(), 'created': time.time(),
+    }
+    get_job_store().create(job)
+    job_executor.submit(run_job, job, func, args)
+    return job_id
+
+def run_job(job, func, args):
+    """Выполняет задачу в потоке job_executor; файл появляется под итоговым именем только готовым"""
+    store = get_job_store()
+    store.update(job['id'], status='running')
+    last_report = 0.0
+    
+    def report(done):
+        # Прогресс пишем не чаще двух раз в секунду
+        nonlocal last_report
+        now = time.monotonic()
+        if now - last_report >= 0.5 or done == job['total']:
+            last_report = now
+            store.update(job['id'], progress=done)
+    
+    part_path = job['path'] + '.part'
+    try:
+        func(part_path, report, *args)
+        os.replace(part_path, job['path'])
+        store.update(job['id'], status='done', progress=job['total'], finished=time.time())
+    except Exception as e:
+        logger.error(f"Job {job['id']} ({job['kind']}) error: {str(e)}")
+        store.update(job['id'], status='error', error=str(e), finished=time.time())
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+def write_reply_files(path, report, template_path, rows, primary_key, fmt='odt'):
+    """Ответ в ODT/PDF (копия из кэша документов) или ZIP с ответами на несколько писем"""
+    if len(rows) == 1:
+        shutil.copyfile(cached_document(template_path, rows[0], fmt), path)
+        report(1)
+        return
+    
+    with open(path, 'wb') as f:
+        for done, chunk in enumerate(iter_documents_zip(template_path, rows, primary_key, fmt), start=1):
+            f.write(chunk)
+            report(min(done, len(rows)))
+
+def write_replies(path, report, engine, table_name, template_path, rows, primary_key, rule, actor,
+                  fmt='odt', renew=False):
+    """Задача: исходящие записи по правилу, затем ответы на письма"""
+    documents = outgoing_records(engine, table_name, rows, primary_key, rule, actor, renew)
+    write_reply_files(path, report, template_path, documents, primary_key, fmt)
+
+# Поиск по таблице на стороне сервера
+SEARCH_TOKEN_RE = re.compile(r'\w+')
+
+def search_tokens(value):
+    """Слова для поискового индекса (в нижнем регистре, без повторов)"""
+    return set(SEARCH_TOKEN_RE.findall(str(value).lower()))
+
+class SearchIndex:
+    """Обратный индекс таблицы в памяти: слово -> первичные ключи строк.
+    
+    Используется, если в таблице нет FULLTEXT-индекса. Ищет по началу слов,
+    все слова запроса должны встретиться в строке.
+    """
+
+    def __init__(self, engine, table_name, primary_key, columns):
+        postings = {}
+        column_list = ', '.join(f'`{col}`' for col in columns)
+        
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=STREAM_BATCH_SIZE).execute(
+                text(f"SELECT `{primary_key}`, {column_list} FROM `{table_name}`"))
+            for row in result:
+                row_tokens = set()
+                for value in row[1:]:
+                    if value is not None:
+                        row_tokens |= search_tokens(value)
+                for token in row_tokens:
+                    postings.setdefault(token, []).append(row[0])
+        
+        self.tokens = sorted(postings)
+        self.postings = postings
+        self.built = time.monotonic()
+
+    def search(self, query):
+        """Первичные ключи строк, где есть все слова запроса (по началу слова), по возрастанию"""
+        found = None
+        for word in search_tokens(query):
+            matched = set()
+            position = bisect.bisect_left(self.tokens, word)
+            while position < len(self.tokens) and self.tokens[position].startswith(word):
+                matched.update(self.postings[self.tokens[position]])
+                position += 1
+            found = matched if found is None else found & matched
+            if not found:
+                return []
+        return sorted(found or [])
+
+# Индексы по таблицам: (БД, таблица) -> SearchIndex, не больше SEARCH_INDEX_MAX_TABLES
+search_indexes = OrderedDict()
+search_indexes_lock = threading.Lock()
+
+def get_search_index(table_name, schema):
+    """Индекс таблицы из кэша; строится при первом поиске и после устаревания"""
+    engine = get_engine()
+    key = (schema_cache_key(engine), table_name)
+    
+    with search_indexes_lock:
+        index = search_indexes.get(key)
+        if index and time.monotonic() - index.built < SEARCH_INDEX_TTL:
+            search_indexes.move_to_end(key)
+            return index
+    
+    text_columns = [col['name'] for col in schema['columns'] if col['type'] == 'TEXT']
+    primary_key = schema['primary_key'] or schema['column_names'][0]
+    index = SearchIndex(engine, table_name, primary_key, text_columns)
+    
+    with search_indexes_lock:
+        search_indexes[key] = index
+        search_indexes.move_to_end(key)
+        while len(search_indexes) > SEARCH_INDEX_MAX_TABLES:
+            search_indexes.popitem(last=False)
+    return index
+
+def invalidate_search_index(table_name, engine=None):
+    """Сбрасывает индекс таблицы после изменения данных через orex"""
+    key = (schema_cache_key(engine or get_engine()), table_name)
+    with search_indexes_lock:
+        search_indexes.pop(key, None)
+
+# Подсказки при вводе: различные значения текстовой колонки (адресаты, темы,
+# отправители) с частотами. Индекс строится при первой подсказке по колонке,
+# save_record/update_record обновляют его на месте - запрос к БД на каждую
+# нажатую клавишу не нужен. У каждого воркера gunicorn свой индекс: правки из
+# других воркеров и Adminer он увидит после SUGGEST_INDEX_TTL
+class SuggestIndex:
+    """Значения колонки, отсортированные без учета регистра, и сколько раз каждое встречается"""
+
+    def __init__(self, engine, table_name, column):
+        counts = {}
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=STREAM_BATCH_SIZE).execute(
+                text(f"SELECT `{column}`, COUNT(*) FROM `{table_name}` "
+                     f"WHERE `{column}` IS NOT NULL GROUP BY `{column}`"))
+            for value, count in result:
+                value = str(value).strip()
+                if value and len(value) <= SUGGEST_MAX_VALUE_LENGTH:
+                    counts[value] = counts.get(value, 0) + count
+        
+        self.values = sorted(counts, key=str.casefold)
+        self.keys = [value.casefold() for value in self.values]
+        self.counts = counts
+        self.lock = threading.Lock()
+        self.built = time.monotonic()
+
+    def add(self, value, delta=1):
+        """Учитывает новое (delta=1) или удаленное (delta=-1) значение"""
+        value = str(value).strip()
+        if not value or len(value) > SUGGEST_MAX_VALUE_LENGTH:
+            return
+        with self.lock:
+            count = self.counts.get(value, 0) + delta
+            key = value.casefold()
+            if count > 0 and value not in self.counts:
+                position = bisect.bisect_right(self.keys, key)
+                self.keys.insert(position, key)
+                self.values.insert(position, value)
+            elif count <= 0 and value in self.counts:
+                position = bisect.bisect_left(self.keys, key)
+                position += self.values[position:].index(value)
+                del self.keys[position], self.values[position]
+            if count > 0:
+                self.counts[value] = count
+            else:
+                self.counts.pop(value, None)
+
+    def suggest(self, prefix, limit=SUGGEST_LIMIT):
+        """Значения, начинающиеся с prefix (без учета регистра), самые частые первыми"""
+        key = prefix.strip().casefold()
+        with self.lock:
+            start = bisect.bisect_left(self.keys, key)
+            end = bisect.bisect_left(self.keys, key + '\U0010ffff', start)
+            return heapq.nlargest(limit, self.values[start:end], key=self.counts.__getitem__)
+
+# Индексы по колонкам: (БД, таблица, колонка) -> SuggestIndex, не больше SUGGEST_MAX_COLUMNS
+suggest_indexes = OrderedDict()
+suggest_indexes_lock = threading.Lock()
+
+def get_suggest_index(table_name, column):
+    """Индекс колонки из кэша; строится при первой подсказке и после устаревания"""
+    engine = get_engine()
+    key = (schema_cache_key(engine), table_name, column)
+    
+    with suggest_indexes_lock:
+        index = suggest_indexes.get(key)
+        if index and time.monotonic() - index.built < SUGGEST_INDEX_TTL:
+            suggest_indexes.move_to_end(key)
+            return index
+    
+    index = SuggestIndex(engine, table_name, column)
+    
+    with suggest_indexes_lock:
+        suggest_indexes[key] = index
+        suggest_indexes.move_to_end(key)
+        while len(suggest_indexes) > SUGGEST_MAX_COLUMNS:
+            suggest_indexes.popitem(last=False)
+    return index
+
+def loaded_suggest_indexes(table_name, engine=None):
+    """Построенные индексы подсказок таблицы: {колонка: SuggestIndex}"""
+    db_key = schema_cache_key(engine or get_engine())
+    with suggest_indexes_lock:
+        return {key[2]: index for key, index in suggest_indexes.items() if key[:2] == (db_key, table_name)}
+
+def update_suggest_indexes(table_name, changes, engine=None):
+    """Переносит в индексы подсказок изменения строк: changes - пары (было, стало), None - нет строки"""
+    for column, index in loaded_suggest_indexes(table_name, engine).items():
+        for old, new in changes:
+            old_value = (old or {}).get(column)
+            new_value = (new or {}).get(column, old_value) if new is not None else None
+            if old_value == new_value:
+                continue
+            if old_value is not None:
+                index.add(old_value, -1)
+            if new_value is not None:
+                index.add(new_value)
+
+def invalidate_suggest_indexes(table_name, engine=None):
+    """Сбрасывает индексы подсказок таблицы (импорт - пересчитывать на месте дороже)"""
+    db_key = schema_cache_key(engine or get_engine())
+    with suggest_indexes_lock:
+        for key in [key for key in suggest_indexes if key[:2] == (db_key, table_name)]:
+            del suggest_indexes[key]
+
+def get_table_filters(args, schema):
+    """Фильтры таблицы из параметров запроса: q, f.<колонка>, from.<колонка>, to.<колонка>.
+    
+    Учитываются только существующие колонки; пустые значения отбрасываются.
+    """
+    filters = {}
+    columns = set(schema['column_names'])
+    for name, value in args.items():
+        value = value.strip()
+        if not value:
+            continue
+        if name == 'q':
+            filters[name] = value
+        elif '.' in name:
+            kind, column = name.split('.', 1)
+            if kind in ('f', 'from', 'to') and column in columns:
+                filters[name] = value
+    return filters
+
+def build_filter_conditions(schema, filters):
+    """Условия WHERE и параметры для фильтров по колонкам и диапазонам дат"""
+    types = {col['name']: col['type'] for col in schema['columns']}
+    conditions = []
+    params = {}
+    
+    for number, (name, value) in enumerate(sorted(filters.items())):
+        if name == 'q':
+            continue
+        kind, column = name.split('.', 1)
+        param = f'filter_{number}'
+        
+        if kind == 'f':
+            if types[column] == 'TEXT':
+                # Подстрока; ! экранирует спецсимволы LIKE
+                escaped = value.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+                conditions.append(f"`{column}` LIKE :{param} ESCAPE '!'")
+                params[param] = f'%{escaped}%'
+            else:
+                conditions.append(f"`{column}` = :{param}")
+                params[param] = value
+        else:
+            day = datetime.strptime(value, '%Y-%m-%d').date()
+            if kind == 'from':
+                conditions.append(f"`{column}` >= :{param}")
+                params[param] = day
+            else:
+                # Включая весь последний день (и для DATETIME)
+                conditions.append(f"`{column}` < :{param}")
+                params[param] = day + timedelta(days=1)
+    
+    return conditions, params
+
+def search_rows_page(conn, table_name, schema, filters, after, limit):
+    """Страница строк с учетом фильтров и полнотекстового поиска.
+    
+    Полнотекстовый запрос идет через FULLTEXT-индекс MariaDB, если он есть,
+    иначе через SearchIndex в памяти.
+    """
+    primary_key = schema['primary_key'] or schema['column_names'][0]
+    conditions, params = build_filter_conditions(schema, filters)
+    query = filters.get('q')
+    
+    if not query:
+        return fetch_rows_page(conn, table_name, primary_key, after, limit, conditions, params)
+    
+    if schema['fulltext']:
+        words = SEARCH_TOKEN_RE.findall(query)
+        columns = ', '.join(f'`{col}`' for col in schema['fulltext'])
+        conditions.append(f"MATCH({columns}) AGAINST (:fulltext IN BOOLEAN MODE)")
+        params['fulltext'] = ' '.join(f'+{word}*' for word in words)
+        return fetch_rows_page(conn, table_name, primary_key, after, limit, conditions, params)
+    
+    candidates = get_search_index(table_name, schema).search(query)
+    if after is not None:
+        # after приходит строкой из URL - приводим к типу ключа для сравнения
+        after = type(candidates[0])(after) if candidates else after
+        candidates = candidates[bisect.bisect_right(candidates, after):]
+    
+    # Кандидатов может быть много - проверяем фильтры порциями, пока не наберем страницу
+    rows = []
+    for start in range(0, len(candidates), SEARCH_CANDIDATES_CHUNK):
+        chunk = candidates[start:start + SEARCH_CANDIDATES_CHUNK]
+        page, _ = fetch_rows_page(conn, table_name, primary_key, None, limit + 1 - len(rows),
+                                  conditions, params, ids=chunk)
+        rows.extend(page)
+        if len(rows) > limit:
+            break
+    
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1][primary_key]
+    return rows, None
+
+# Приведение значений из формы или файла к типам колонок
+TRUE_VALUES = {'1', 'true', 'да', 'yes', 'on', '+'}
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M',
+                    '%d.%m.%Y %H:%M')
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y') + DATETIME_FORMATS
+
+class RequiredFieldError(ValueError):
+    """Не заполнено обязательное поле без значения по умолчанию"""
+
+def parse_datetime(value, formats):
+    """Дата/время в одном из форматов formats"""
+    for date_format in formats:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ValueError(f'Неверный формат даты: "{value}"')
+
+def coerce_column_value(col, value):
+    """Непустое значение из формы или файла -> значение для колонки"""
+    if col['type'] == 'BOOLEAN' or 'галочка' in col['name'].lower():
+        return 1 if value.strip().lower() in TRUE_VALUES else 0
+    if col['type'] == 'DATE':
+        return parse_datetime(value, DATE_FORMATS).date()
+    if col['type'] == 'DATETIME':
+        return parse_datetime(value, DATETIME_FORMATS)
+    return value
+
+def build_record_data(columns_meta, values, skip=()):
+    """Данные записи для INSERT/UPDATE из значений формы или строки файла.
+    
+    Автоинкрементные колонки и колонки из skip пропускаются. Пустое значение
+    становится NULL или, если колонка NOT NULL, берется значение по умолчанию.
+    Если нет и его - RequiredFieldError.
+    """
+    data = {}
+    for col in columns_meta:
+        col_name = col['name']
+        if col['autoincrement'] or col_name in skip:
+            continue
+        
+        value = values.get(col_name)
+        if value is None or value == '':
+            if col['nullable']:
+                data[col_name] = None
+            elif col['default'] is not None:
+                continue
+            else:
+                raise RequiredFieldError(f'Поле "{col_name}" обязательно для заполнения')
+        else:
+            data[col_name] = coerce_column_value(col, value)
+    return data
+
+# Чтение файлов импорта построчно - файл целиком в память не загружается
+ODS_OFFICE_NS = 'urn:oasis:names:tc:opendocument:xmlns:office:1.0'
+ODS_TABLE_NS = 'urn:oasis:names:tc:opendocument:xmlns:table:1.0'
+ODS_TEXT_NS = 'urn:oasis:names:tc:opendocument:xmlns:text:1.0'
+ODS_MAX_REPEAT = 1000  # Больше повторов пустых ячеек/строк - это "хвост" листа, а не данные
+
+def iter_csv_rows(stream):
+    """Строки CSV в UTF-8; разделитель (; или ,) определяется по заголовку"""
+    lines = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    header = lines.readline()
+    delimiter = ';' if header.count(';') > header.count(',') else ','
+    yield from csv.reader(itertools.chain([header], lines), delimiter=delimiter)
+
+def ods_cell_value(cell):
+    """Значение ячейки ODS строкой (даты - в ISO, как их пишет LibreOffice)"""
+    value_type = cell.get(f'{{{ODS_OFFICE_NS}}}value-type')
+    if value_type == 'date':
+        return cell.get(f'{{{ODS_OFFICE_NS}}}date-value')
+    if value_type in ('float', 'percentage', 'currency'):
+        return cell.get(f'{{{ODS_OFFICE_NS}}}value')
+    if value_type == 'boolean':
+        return '1' if cell.get(f'{{{ODS_OFFICE_NS}}}boolean-value') == 'true' else '0'
+    return '\n'.join(''.join(p.itertext()) for p in cell.iter(f'{{{ODS_TEXT_NS}}}p'))
+
+def iter_ods_rows(stream):
+    """Строки первого листа ODS; content.xml разбирается потоково (iterparse)"""
+    row_tag = f'{{{ODS_TABLE_NS}}}table-row'
+    cell_tags = (f'{{{ODS_TABLE_NS}}}table-cell', f'{{{ODS_TABLE_NS}}}covered-table-cell')
+    
+    with zipfile.ZipFile(stream) as archive, archive.open('content.xml') as content:
+        for _, element in ElementTree.iterparse(content):
+            if element.tag == f'{{{ODS_TABLE_NS}}}table':
+                return
+            if element.tag != row_tag:
+                continue
+            
+            values = []
+            for cell in element:
+                if cell.tag not in cell_tags:
+                    continue
+                value = ods_cell_value(cell)
+                repeat = int(cell.get(f'{{{ODS_TABLE_NS}}}number-columns-repeated', 1))
+                if value or repeat <= ODS_MAX_REPEAT:
+                    values.extend([value] * repeat)
+            while values and not values[-1]:
+                values.pop()
+            
+            repeat = int(element.get(f'{{{ODS_TABLE_NS}}}number-rows-repeated', 1))
+            element.clear()
+            if values:
+                for _ in range(min(repeat, ODS_MAX_REPEAT)):
+                    yield values
+
+def import_rows(engine, table_name, columns_meta, rows, skip_errors=False, dry_run=False):
+    """Импорт строк файла в таблицу; первая строка - заголовок с именами колонок.
+    
+    Проверка и вставка идут за один проход: строки приводятся к типам колонок
+    и вставляются пачками по IMPORT_BATCH_SIZE (executemany) в одной транзакции.
+    При ошибках в строках транзакция откатывается, если не задан skip_errors;
+    при dry_run откатывается всегда. Возвращает словарь с итогами и списком
+    ошибок (номер строки файла, текст).
+    """
+    header = [str(name).strip() for name in next(rows, [])]
+    if not any(header):
+        raise ValueError('Файл пуст')
+    
+    known = {col['name'] for col in columns_meta}
+    unknown = [name for name in header if name and name not in known]
+    if unknown:
+        raise ValueError(f'В таблице нет колонок: {", ".join(unknown)}')
+    
+    result = {'total': 0, 'inserted': 0, 'error_count': 0, 'errors': [], 'committed': False}
+    batches = {}  # набор колонок -> строки (у строк с пропущенными колонками свой INSERT)
+    
+    def flush(keys, line):
+        batch = batches.pop(keys)
+        columns_str = ', '.join(f'`{col}`' for col in keys)
+        values_str = ', '.join(f':{col}' for col in keys)
+        try:
+            conn.execute(text(f"INSERT INTO `{table_name}` ({columns_str}) VALUES ({values_str})"), batch)
+        except Exception as e:
+            raise RuntimeError(f'Ошибка БД при вставке строк до {line}: {str(e)}')
+        result['inserted'] += len(batch)
+    
+    with engine.connect() as conn:
+        with conn.begin() as transaction:
+            line = 1
+            for line, values in enumerate(rows, start=2):
+                values = {name: str(value).strip() for name, value in zip(header, values)}
+                if not any(values.values()):
+                    continue
+                result['total'] += 1
+                
+                try:
+                    data = build_record_data(columns_meta, values)
+                except ValueError as e:
+                    result['error_count'] += 1
+                    if len(result['errors']) < IMPORT_MAX_ERRORS:
+                        result['errors'].append((line, str(e)))
+                    continue
+                
+                keys = tuple(data)
+                batches.setdefault(keys, []).append(data)
+                if len(batches[keys]) >= IMPORT_BATCH_SIZE:
+                    flush(keys, line)
+            
+            for keys in list(batches):
+                flush(keys, line)
+            
+            if dry_run or (result['error_count'] and not skip_errors):
+                transaction.rollback()
+            else:
+                result['committed'] = True
+    
+    return result
+
+# Исходящие записи при генерации ответа.
+# Правила в REPLY_RULES_FILE (пример - tools/reply-rules.example.json):
+# для таблицы писем задается таблица исходящих, какие колонки переносятся (copy),
+# какие формируются по шаблону (values: "{Номер}", "{today}", "{Дата:%d.%m.%Y}")
+# и автонумерация (number). Поля созданной записи доступны в шаблоне ответа
+# с префиксом prefix (по умолчанию "исх_"), например $исх_Номер
+reply_rules_cache = {'mtime': None, 'rules': {}}
+reply_rules_lock = threading.Lock()
+# Строка счетчика номеров заблокирована до COMMIT только на MariaDB; внутри процесса
+# (и на SQLite) выдачу номера и вставку упорядочивает эта блокировка
+outgoing_lock = threading.Lock()
+outgoing_tables_ready = set()
+
+def load_reply_rules():
+    """Правила из файла (перечитываются при его изменении); нет файла - нет правил"""
+    try:
+        mtime = os.stat(REPLY_RULES_FILE).st_mtime
+    except FileNotFoundError:
+        return {}
+    
+    with reply_rules_lock:
+        if reply_rules_cache['mtime'] != mtime:
+            with open(REPLY_RULES_FILE, 'r', encoding='utf-8') as f:
+                reply_rules_cache['rules'] = json.load(f)
+            reply_rules_cache['mtime'] = mtime
+        return reply_rules_cache['rules']
+
+def has_reply_rule(table_name):
+    """Есть ли для таблицы правило исходящих (для страницы; битый файл правил страницу не ломает)"""
+    try:
+        return table_name in load_reply_rules()
+    except ValueError:
+        return False
+
+def get_reply_rule(table_name):
+    """Правило для таблицы вместе с колонками таблицы исходящих или None.
+    
+    Вызывается в запросе: структура берется из кэша текущей сессии.
+    """
+    rule = load_reply_rules().get(table_name)
+    if not rule:
+        return None
+    
+    target_columns = {col['name']: col for col in get_table_metadata(rule['target'])}
+    used = list(rule.get('copy', {})) + list(rule.get('values', {}))
+    if rule.get('number'):
+        used.append(rule['number']['column'])
+    unknown = [col for col in used if col not in target_columns]
+    if unknown:
+        raise ValueError(f'В таблице {rule["target"]} нет колонок: {", ".join(unknown)}')
+    return dict(rule, target_columns=target_columns)
+
+def ensure_outgoing_tables(engine):
+    """Создает таблицы счетчиков номеров и связей письмо -> исходящая запись
+    (отдельной транзакцией: DDL в MariaDB завершает текущую)"""
+    if schema_cache_key(engine) in outgoing_tables_ready:
+        return
+    with engine.begin() as conn:
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {OUTGOING_COUNTERS_TABLE} ("
+            f"target VARCHAR(64) NOT NULL, counter_year INTEGER NOT NULL, last_number INTEGER NOT NULL, "
+            f"PRIMARY KEY (target, counter_year))"))
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {OUTGOING_LINKS_TABLE} ("
+            f"source_table VARCHAR(64) NOT NULL, source_id VARCHAR(64) NOT NULL, target VARCHAR(64) NOT NULL, "
+            f"record TEXT NOT NULL, PRIMARY KEY (source_table, source_id, target))"))
+    outgoing_tables_ready.add(schema_cache_key(engine))
+
+def outgoing_number_pattern(numbering):
+    """Регулярное выражение, достающее n из готового номера по формату: "{n}/исх" -> (\\d+)/исх"""
+    parts = []
+    for token in re.split(r'(\{[^}]*\})', numbering.get('format', '{n}')):
+        if re.fullmatch(r'\{n(?:[:!][^}]*)?\}', token):
+            parts.append(r'(\d+)')
+        elif token.startswith('{') and token.endswith('}'):
+            parts.append('.*?')
+        else:
+            parts.append(re.escape(token))
+    return re.compile(''.join(parts))
+
+def max_outgoing_number(conn, rule, year):
+    """Наибольший номер, уже выданный в таблице исходящих (за год year или за все время, если 0).
+    Читается один раз - при создании счетчика"""
+    numbering = rule['number']
+    query = f"SELECT `{numbering['column']}` FROM `{rule['target']}`"
+    params = {}
+    if year:
+        query += f" WHERE `{numbering['yearly_by']}` >= :year_start AND `{numbering['yearly_by']}` < :year_end"
+        params = {'year_start': date(year, 1, 1), 'year_end': date(year + 1, 1, 1)}
+    
+    pattern = outgoing_number_pattern(numbering)
+    largest = 0
+    for (value,) in conn.execute(text(query), params):
+        if isinstance(value, int):
+            largest = max(largest, value)
+        elif value is not None:
+            match = pattern.fullmatch(str(value).strip())
+            if match:
+                largest = max(largest, int(match.group(1)))
+    return largest
+
+def reserve_outgoing_numbers(conn, rule, count):
+    """Первый из count подряд идущих номеров исходящих.
+    
+    Номера выдает строка счетчика (таблица исходящих, год) в OUTGOING_COUNTERS_TABLE,
+    заблокированная до COMMIT: параллельный ответ ждет только ее, ввод записей в
+    таблицу исходящих не блокируется. Удаление записей номер не уменьшает - выданный
+    номер не повторяется. Новый счетчик продолжает наибольший уже выданный номер.
+    """
+    numbering = rule['number']
+    params = {'target': rule['target'], 'year': date.today().year if numbering.get('yearly_by') else 0}
+    mysql = conn.dialect.name in ('mysql', 'mariadb')
+    query = text(f"SELECT last_number FROM {OUTGOING_COUNTERS_TABLE} "
+                 f"WHERE target = :target AND counter_year = :year" + (" FOR UPDATE" if mysql else ""))
+    
+    last = conn.execute(query, params).scalar()
+    if last is None:
+        # Два воркера могут создавать счетчик одновременно - второй INSERT ничего не сделает
+        conn.execute(text(f"INSERT {'IGNORE' if mysql else 'OR IGNORE'} INTO {OUTGOING_COUNTERS_TABLE} "
+                          f"(target, counter_year, last_number) VALUES (:target, :year, :last)"),
+                     dict(params, last=max_outgoing_number(conn, rule, params['year'])))
+        last = conn.execute(query, params).scalar()
+    
+    conn.execute(text(f"UPDATE {OUTGOING_COUNTERS_TABLE} SET last_number = :last "
+                      f"WHERE target = :target AND counter_year = :year"), dict(params, last=last + count))
+    return last + 1
+
+def build_outgoing_record(rule, row, number):
+    """Значения исходящей записи для одной строки письма"""
+    columns = rule['target_columns']
+    context = {str(key): '' if value is None else value for key, value in row.items()}
+    context.update(today=date.today(), now=datetime.now().replace(microsecond=0), n=number)
+    
+    record = {target: row.get(source) for target, source in rule.get('copy', {}).items()}
+    for target, template in rule.get('values', {}).items():
+        record[target] = coerce_column_value(columns[target], template.format_map(context))
+    if number is not None:
+        numbering = rule['number']
+        record[numbering['column']] = coerce_column_value(
+            columns[numbering['column']], numbering.get('format', '{n}').format_map(context))
+    return record
+
+def insert_outgoing_records(conn, rule, rows):
+    """Исходящие записи для строк одним INSERT с несколькими VALUES"""
+    number = reserve_outgoing_numbers(conn, rule, len(rows)) if rule.get('number') else None
+    records = [build_outgoing_record(rule, row, None if number is None else number + i)
+               for i, row in enumerate(rows)]
+    
+    columns = list(records[0])
+    values_sql = ', '.join('(' + ', '.join(f':v{i}_{j}' for j in range(len(columns))) + ')'
+                           for i in range(len(records)))
+    params = {f'v{i}_{j}': record[col] for i, record in enumerate(records) for j, col in enumerate(columns)}
+    columns_str = ', '.join(f'`{col}`' for col in columns)
+    conn.execute(text(f"INSERT INTO `{rule['target']}` ({columns_str}) VALUES {values_sql}"), params)
+    return records
+
+def read_outgoing_links(conn, table_name, target, source_ids):
+    """Уже созданные исходящие записи писем: id письма (строкой) -> значения записи"""
+    query = text(f"SELECT source_id, record FROM {OUTGOING_LINKS_TABLE} "
+                 f"WHERE source_table = :source AND target = :target AND source_id IN :ids"
+                 ).bindparams(bindparam('ids', expanding=True))
+    result = conn.execute(query, {'source': table_name, 'target': target, 'ids': source_ids})
+    return {source_id: json.loads(record) for source_id, record in result}
+
+def save_outgoing_links(conn, table_name, target, links):
+    """Запоминает исходящие записи писем (links: id письма -> значения записи), прежние связи заменяются"""
+    conn.execute(text(f"DELETE FROM {OUTGOING_LINKS_TABLE} "
+                      f"WHERE source_table = :source AND target = :target AND source_id IN :ids"
+                      ).bindparams(bindparam('ids', expanding=True)),
+                 {'source': table_name, 'target': target, 'ids': list(links)})
+    conn.execute(text(f"INSERT INTO {OUTGOING_LINKS_TABLE} (source_table, source_id, target, record) "
+                      f"VALUES (:source, :source_id, :target, :record)"),
+                 [{'source': table_name, 'source_id': source_id, 'target': target,
+                   'record': json.dumps({col: json_value(value) for col, value in record.items()},
+                                        ensure_ascii=False)}
+                  for source_id, record in links.items()])
+
+def outgoing_records(engine, table_name, rows, primary_key, rule, actor, renew=False):
+    """Строки писем для шаблона ответа вместе с полями их исходящих записей.
+    
+    Исходящая запись создается по правилу один раз на письмо: повторная генерация
+    ответа (повторное скачивание, двойной клик) берет уже созданную запись и ее номер,
+    renew=True - создать новую запись с новым номером. Записи фиксируются до генерации
+    документов: номера не заблокированы, пока собирается ODT или PDF, а если генерация
+    упадет, повтор возьмет те же записи. Без правила строки отдаются как есть.
+    """
+    if rule is None:
+        return rows
+    
+    prefix = rule.get('prefix', 'исх_')
+    ensure_outgoing_tables(engine)
+    source_ids = [str(row[primary_key]) for row in rows]
+    created = {}
+    
+    for attempt in range(2):
+        try:
+            with outgoing_lock, engine.begin() as conn:
+                records = {} if renew else read_outgoing_links(conn, table_name, rule['target'], source_ids)
+                new_ids = [source_id for source_id in source_ids if source_id not in records]
+                if new_ids:
+                    new_rows = [row for row, source_id in zip(rows, source_ids) if source_id not in records]
+                    created = dict(zip(new_ids, insert_outgoing_records(conn, rule, new_rows)))
+                    save_outgoing_links(conn, table_name, rule['target'], created)
+                    records.update(created)
+            break
+        except IntegrityError:
+            # Запись для того же письма одновременно создал другой воркер - берем ее
+            if attempt:
+                raise
+            renew = False
+            created = {}
+    
+    if created:
+        table_data_changed(rule['target'], engine, changes=[(None, record) for record in created.values()])
+        audit('outgoing_insert', table=rule['target'], source_table=table_name,
+              source_ids=list(created), rows=len(created), renewed=renew, **actor)
+    return [{**row, **{prefix + col: value for col, value in records[source_id].items()}}
+            for row, source_id in zip(rows, source_ids)]
+
+def reply_rule_source_columns(rule):
+    """Колонки письма, которые читает правило исходящих (copy и поля в шаблонах values/number)"""
+    columns = set(rule.get('copy', {}).values())
+    templates = list(rule.get('values', {}).values())
+    if rule.get('number'):
+        templates.append(rule['number'].get('format', '{n}'))
+    for template in templates:
+        for _, field, _, _ in string.Formatter().parse(template):
+            if field:
+                columns.add(re.split(r'[.\[]', field, 1)[0])
+    return columns - {'today', 'now', 'n'}
+
+def fetch_reply_rows(conn, table_name, schema, template_path, row_ids, rule=None):
+    """Строки писем для ответа по первичному ключу - только колонки, которые
+    использует шаблон (его плейсхолдеры) и правило исходящих"""
+    primary_key = schema['primary_key'] or schema['column_names'][0]
+    needed = get_compiled_template(template_path).placeholders
+    if rule:
+        needed = needed | reply_rule_source_columns(rule)
+    columns = [col for col in schema['column_names'] if col in needed or col == primary_key]
+    
+    query = text(f"SELECT {', '.join(f'`{col}`' for col in columns)} FROM `{table_name}` "
+                 f"WHERE `{primary_key}` IN :ids").bindparams(bindparam('ids', expanding=True))
+    return [dict(row) for row in conn.execute(query, {'ids': row_ids}).mappings()]
+
+# Кэш готовых страниц таблиц: ETag для браузера и LRU отрендеренных ответов на сервере.
+# Страница зависит от версии данных таблицы: счетчика правок через orex и
+# UPDATE_TIME из information_schema (его видят все воркеры и правки через Adminer)
+table_versions = {}
+table_versions_lock = threading.Lock()
+
+class PageCache:
+    """LRU готовых ответов по ETag, ограниченный суммарным размером"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, etag):
+        with self.lock:
+            entry = self.entries.get(etag)
+            if entry is not None:
+                self.entries.move_to_end(etag)
+            return entry
+
+    def put(self, etag, body, mimetype):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(etag, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[etag] = (body, mimetype)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+page_cache = PageCache(PAGE_CACHE_MAX_BYTES)
+
+def get_table_update_time(eng, table_name):
+    """UPDATE_TIME таблицы и текущее время сервера БД (MariaDB/MySQL), для остальных БД None"""
+    if eng.dialect.name not in ('mysql', 'mariadb'):
+        return None
+    with eng.connect() as conn:
+        return conn.execute(
+            text("SELECT UPDATE_TIME, NOW() FROM information_schema.TABLES "
+                 "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name"),
+            {'name': table_name}
+        ).first()
+
+def table_page_etag(kind, table_name, schema):
+    """ETag страницы таблицы для текущего запроса или None, если страницу нельзя кэшировать"""
+    engine = get_engine()
+    db_key = schema_cache_key(engine)
+    with table_versions_lock:
+        version = table_versions.get((db_key, table_name), 0)
+    
+    marker = None
+    if engine.dialect.name in ('mysql', 'mariadb'):
+        times = get_table_update_time(engine, table_name)
+        if times is None:
+            return None
+        update_time, now = times
+        # UPDATE_TIME с точностью до секунды: только что измененную таблицу не кэшируем,
+        # иначе правка в другом воркере в ту же секунду останется незамеченной
+        if update_time is not None and (now - update_time).total_seconds() < 2:
+            return None
+        if update_time is not None:
+            marker = str(update_time)
+    if marker is None:
+        # Нет UPDATE_TIME (SQLite; MariaDB после перезапуска или общее табличное
+        # пространство InnoDB) - правки других воркеров и Adminer видны через PAGE_CACHE_TTL
+        marker = int(time.time() // PAGE_CACHE_TTL)
+    
+    key = repr((kind, db_key, table_name, sorted(request.args.items(multi=True)), version, marker,
+                schema['column_names'], str(schema['create_time']), sorted(get_template_list()),
+                has_reply_rule(table_name)))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def cached_table_page(kind, table_name, schema, render):
+    """Отдает страницу таблицы через кэш: 304, если она уже есть у браузера,
+    готовый ответ из LRU, иначе render() и сохранение результата"""
+    # Сообщения flash показываются один раз - такие страницы не кэшируем
+    if request.method != 'GET' or session.get('_flashes'):
+        return render()
+    
+    etag = table_page_etag(kind, table_name, schema)
+    if etag is None:
+        return render()
+    
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        cached = page_cache.get(etag)
+        if cached is not None:
+            response = Response(cached[0], mimetype=cached[1])
+        else:
+            response = make_response(render())
+            if response.status_code != 200:
+                return response
+            page_cache.put(etag, response.get_data(), response.mimetype)
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def table_data_changed(table_name, engine=None, changes=None):
+    """Отмечает изменение данных таблицы через orex: новая версия страниц, сброс индекса поиска.
+    
+    engine передается из фоновых задач, где нет сессии. changes - пары (было, стало)
+    измененных строк: по ним индексы подсказок обновляются на месте, без них - сбрасываются.
+    Сводку отчета правка обновляет сама, в своей транзакции (update_report_summaries).
+    """
+    engine = engine or get_engine()
+    key = (schema_cache_key(engine), table_name)
+    with table_versions_lock:
+        table_versions[key] = table_versions.get(key, 0) + 1
+    invalidate_search_index(table_name, engine)
+    if changes is None:
+        invalidate_suggest_indexes(table_name, engine)
+    else:
+        update_suggest_indexes(table_name, changes, engine)
+
+# Отчеты: письма по месяцам и годам, по адресатам, отвеченные и нет. Читаются не из
+# таблицы, а из сводки REPORT_SUMMARY_TABLE (таблица, колонка, месяц, значение -> писем)
+# в той же БД. Новые записи досчитываются от водяного знака - последнего учтенного
+# первичного ключа - кусками по REPORT_CHUNK_ROWS строк; правки и удаления через orex
+# переносятся в сводку на месте (table_data_changed). Правки мимо orex (Adminer)
+# исправляет полный пересчет раз в REPORT_REBUILD_INTERVAL, тоже кусками
+report_rules_cache = {'mtime': None, 'rules': {}}
+report_rules_lock = threading.Lock()
+report_refresh_lock = threading.Lock()
+report_tables_ready = set()
+
+def load_report_rules():
+    """Правила отчетов из файла (перечитываются при его изменении); нет файла - правил нет"""
+    try:
+        mtime = os.stat(REPORTS_FILE).st_mtime
+    except FileNotFoundError:
+        return {}
+    
+    with report_rules_lock:
+        if report_rules_cache['mtime'] != mtime:
+            with open(REPORTS_FILE, 'r', encoding='utf-8') as f:
+                report_rules_cache['rules'] = json.load(f)
+            report_rules_cache['mtime'] = mtime
+        return report_rules_cache['rules']
+
+def get_report_definition(table_name, schema):
+    """Что сводить по таблице: колонка даты, колонки-категории, первичный ключ.
+    
+    Без правила в REPORTS_FILE берется первая колонка-дата и колонки с галочкой,
+    статусом и адресатом. None - отчет невозможен (нет даты или целого ключа).
+    """
+    columns = {col['name']: col for col in schema['columns']}
+    primary_key = schema['primary_key']
+    if primary_key is None or columns[primary_key]['type'] != 'INTEGER':
+        return None
+    
+    rule = load_report_rules().get(table_name)
+    if rule:
+        date_column = rule['date']
+        categories = list(rule.get('categories', []))
+        unknown = [col for col in [date_column] + categories if col not in columns]
+        if unknown:
+            raise ValueError(f'В таблице {table_name} нет колонок: {", ".join(unknown)}')
+    else:
+        date_column = next((col['name'] for col in schema['columns'] if col['type'] == 'DATE'), None)
+        categories = [col['name'] for col in schema['columns']
+                      if col['name'] not in (date_column, primary_key)
+                      and (col['type'] == 'BOOLEAN' or any(hint in col['name'].lower()
+                                                           for hint in REPORT_CATEGORY_HINTS))]
+    if date_column is None:
+        return None
+    return {'date': date_column, 'categories': categories, 'primary_key': primary_key}
+
+def report_tables_exist(engine):
+    """Есть ли в БД таблицы сводки (без них правкам нечего обновлять)"""
+    key = schema_cache_key(engine)
+    if key in report_tables_ready:
+        return True
+    if inspect(engine).has_table(REPORT_STATE_TABLE):
+        report_tables_ready.add(key)
+        return True
+    return False
+
+def ensure_report_tables(engine):
+    """Создает таблицы сводки при первом отчете (нужно право CREATE в БД)"""
+    if schema_cache_key(engine) in report_tables_ready:
+        return
+    with engine.begin() as conn:
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {REPORT_SUMMARY_TABLE} ("
+            f"source_table VARCHAR(64) NOT NULL, dimension VARCHAR(64) NOT NULL, "
+            f"period VARCHAR(7) NOT NULL, category VARCHAR({REPORT_CATEGORY_LENGTH}) NOT NULL, "
+            f"letters INTEGER NOT NULL, PRIMARY KEY (source_table, dimension, period, category))"))
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {REPORT_STATE_TABLE} ("
+            f"source_table VARCHAR(64) NOT NULL PRIMARY KEY, definition TEXT NOT NULL, "
+            f"watermark BIGINT NOT NULL, rebuilt DOUBLE NOT NULL)"))
+    report_tables_ready.add(schema_cache_key(engine))
+
+def report_period(value):
+    """Месяц 'ГГГГ-ММ' значения колонки даты; '' - даты нет"""
+    if isinstance(value, (date, datetime)):
+        return value.strftime('%Y-%m')
+    value = str(value or '')
+    return value[:7] if re.match(r'\d{4}-\d{2}', value) else ''
+
+def report_period_sql(eng, column):
+    """То же, что report_period, но в SQL - чтобы GROUP BY шел по месяцам, а не по дням"""
+    if eng.dialect.name in ('mysql', 'mariadb'):
+        return f"DATE_FORMAT(`{column}`, '%Y-%m')"
+    return f"strftime('%Y-%m', `{column}`)"
+
+def report_category(value):
+    """Значение колонки-категории для сводки: строка, пусто - ''"""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        value = int(value)
+    return str(value).strip()[:REPORT_CATEGORY_LENGTH]
+
+def add_report_counts(counts, definition, period, values, letters):
+    """Прибавляет letters писем месяца period со значениями values к counts:
+    в общий итог (колонка '') и по каждой колонке-категории"""
+    keys = [('', period, '')] + [(column, period, report_category(values.get(column)))
+                                 for column in definition['categories']]
+    for key in keys:
+        counts[key] = counts.get(key, 0) + letters
+
+def upsert_report_counts(conn, table_name, counts):
+    """Прибавляет counts {(колонка, месяц, значение): писем} к сводке; счетчик может уменьшаться"""
+    rows = [{'table': table_name, 'dimension': dimension, 'period': period, 'category': category,
+             'letters': letters}
+            for (dimension, period, category), letters in counts.items() if letters]
+    if not rows:
+        return
+    
+    query = (f"INSERT INTO {REPORT_SUMMARY_TABLE} (source_table, dimension, period, category, letters) "
+             f"VALUES (:table, :dimension, :period, :category, :letters) ")
+    if conn.dialect.name in ('mysql', 'mariadb'):
+        query += "ON DUPLICATE KEY UPDATE letters = letters + VALUES(letters)"
+    else:
+        query += ("ON CONFLICT (source_table, dimension, period, category) "
+                  "DO UPDATE SET letters = letters + excluded.letters")
+    conn.execute(text(query), rows)
+    
+    if any(row['letters'] < 0 for row in rows):
+        conn.execute(text(f"DELETE FROM {REPORT_SUMMARY_TABLE} WHERE source_table = :table AND letters <= 0"),
+                     {'table': table_name})
+
+def read_report_state(conn, table_name):
+    """Строка водяного знака таблицы; на MariaDB блокируется до конца транзакции,
+    чтобы досчет и правка из разных воркеров не учли одну запись дважды"""
+    query = f"SELECT definition, watermark, rebuilt FROM {REPORT_STATE_TABLE} WHERE source_table = :table"
+    if conn.dialect.name in ('mysql', 'mariadb'):
+        query += " FOR UPDATE"
+    return conn.execute(text(query), {'table': table_name}).first()
+
+def refresh_report(engine, table_name, definition):
+    """Доводит сводку таблицы до текущих данных, возвращает число досчитанных записей.
+    
+    Сводка считается заново, если ее еще нет, поменялось правило или прошло
+    REPORT_REBUILD_INTERVAL. Иначе читаются только записи выше водяного знака.
+    Каждый кусок - отдельная короткая транзакция вместе со сдвигом знака.
+    """
+    ensure_report_tables(engine)
+    primary_key = definition['primary_key']
+    definition_json = json.dumps(definition, ensure_ascii=False, sort_keys=True)
+    params = {'table': table_name}
+    
+    with report_refresh_lock:
+        with engine.begin() as conn:
+            state = read_report_state(conn, table_name)
+            if (state is None or state.definition != definition_json
+                    or time.time() - state.rebuilt > REPORT_REBUILD_INTERVAL):
+                min_pk = conn.execute(text(f"SELECT MIN(`{primary_key}`) FROM `{table_name}`")).scalar()
+                conn.execute(text(f"DELETE FROM {REPORT_SUMMARY_TABLE} WHERE source_table = :table"), params)
+                conn.execute(text(f"DELETE FROM {REPORT_STATE_TABLE} WHERE source_table = :table"), params)
+                conn.execute(text(f"INSERT INTO {REPORT_STATE_TABLE} (source_table, definition, watermark, rebuilt) "
+                                  f"VALUES (:table, :definition, :watermark, :rebuilt)"),
+                             dict(params, definition=definition_json, watermark=(min_pk or 1) - 1,
+                                  rebuilt=time.time()))
+                logger.info(f"Report summary rebuild: {table_name}")
+            max_pk = get_max_pk(conn, table_name, primary_key)
+        
+        categories = definition['categories']
+        columns = ', '.join([report_period_sql(engine, definition['date'])] + [f'`{col}`' for col in categories])
+        aggregate = text(f"SELECT {columns}, COUNT(*) FROM `{table_name}` "
+                         f"WHERE `{primary_key}` > :start AND `{primary_key}` <= :end "
+                         f"GROUP BY {', '.join(str(i) for i in range(1, len(categories) + 2))}")
+        # Граница куска - по числу строк, а не по значению ключа: дыры в нумерации не дают пустых кусков
+        chunk_end = text(f"SELECT `{primary_key}` FROM `{table_name}` WHERE `{primary_key}` > :start "
+                         f"ORDER BY `{primary_key}` LIMIT 1 OFFSET {REPORT_CHUNK_ROWS - 1}")
+        
+        counted = 0
+        while max_pk is not None:
+            with engine.begin() as conn:
+                start = read_report_state(conn, table_name).watermark
+                if start >= max_pk:
+                    break
+                end = min(conn.execute(chunk_end, {'start': start}).scalar() or max_pk, max_pk)
+                counts = {}
+                for row in conn.execute(aggregate, {'start': start, 'end': end}):
+                    add_report_counts(counts, definition, row[0] or '', dict(zip(categories, row[1:-1])), row[-1])
+                    counted += row[-1]
+                upsert_report_counts(conn, table_name, counts)
+                conn.execute(text(f"UPDATE {REPORT_STATE_TABLE} SET watermark = :end WHERE source_table = :table"),
+                             dict(params, end=end))
+        return counted
+
+def lock_report_state(conn, table_name):
+    """Водяной знак сводки таблицы для правки через orex или None, если сводки нет.
+    
+    Берется в транзакции правки до изменения данных: на MariaDB строка знака остается
+    заблокированной до COMMIT, и досчет refresh_report в другом воркере не прочитает
+    уже измененную строку раньше, чем правка перенесет ее в сводку.
+    """
+    if not report_tables_exist(conn.engine):
+        return None
+    return read_report_state(conn, table_name)
+
+def update_report_summaries(conn, table_name, state, changes):
+    """Переносит в сводку правки и удаления записей в той же транзакции, что и сама правка.
+    
+    state - из lock_report_state, changes - пары (было, стало). Новые записи (было = None)
+    не трогаем - их досчитает refresh_report от водяного знака, как и записи выше знака.
+    """
+    changes = [(old, new) for old, new in changes if old]
+    if state is None or not changes:
+        return
+    
+    definition = json.loads(state.definition)
+    watermark = state.watermark
+    counts = {}
+    for old, new in changes:
+        pk = old.get(definition['primary_key'])
+        if pk is None or int(pk) > state.watermark:
+            continue
+        add_report_counts(counts, definition, report_period(old.get(definition['date'])), old, -1)
+        if new is None:
+            # Удаляется только последняя запись, и ее номер выдается снова - он должен досчитаться
+            watermark = min(watermark, int(pk) - 1)
+        else:
+            current = dict(old, **new)
+            add_report_counts(counts, definition, report_period(current.get(definition['date'])), current, 1)
+    upsert_report_counts(conn, table_name, counts)
+    if watermark != state.watermark:
+        conn.execute(text(f"UPDATE {REPORT_STATE_TABLE} SET watermark = :watermark WHERE source_table = :table"),
+                     {'watermark': watermark, 'table': table_name})
+
+def load_report(engine, table_name, dimension, by_year=False):
+    """Отчет из сводки: периоды (месяцы или годы) x значения колонки dimension ('' - только итог).
+    
+    Значения сверх REPORT_MAX_CATEGORIES самых частых сводятся в "прочие" (ключ None).
+    """
+    length = 4 if by_year else 7
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text(f"SELECT SUBSTR(period, 1, {length}), category, SUM(letters) FROM {REPORT_SUMMARY_TABLE} "
+                 f"WHERE source_table = :table AND dimension = :dimension "
+                 f"GROUP BY SUBSTR(period, 1, {length}), category"),
+            {'table': table_name, 'dimension': dimension}
+        ).all()
+    
+    totals = {}
+    for _, category, letters in rows:
+        totals[category] = totals.get(category, 0) + int(letters)
+    categories = sorted(totals, key=lambda category: (-totals[category], category))[:REPORT_MAX_CATEGORIES]
+    shown = set(categories)
+    
+    periods = {}
+    for period, category, letters in rows:
+        cells = periods.setdefault(period, {})
+        key = category if category in shown else None
+        cells[key] = cells.get(key, 0) + int(letters)
+    
+    column_totals = {category: totals[category] for category in categories}
+    if len(totals) > len(categories):
+        column_totals[None] = sum(letters for category, letters in totals.items() if category not in shown)
+    # Записи без даты - в конце
+    return {
+        'categories': categories,
+        'other': None in column_totals,
+        'periods': sorted(periods.items(), key=lambda item: (item[0] == '', item[0])),
+        'totals': column_totals,
+        'total': sum(totals.values()),
+    }
+
+# Резервные копии. Полный снимок таблиц - раз в BACKUP_FULL_INTERVAL, между ними
+# инкрементальные бэкапы. Таблица с целым первичным ключом режется на куски по
+# BACKUP_CHUNK_ROWS значений ключа; в инкрементальный бэкап пишутся только куски,
+# у которых изменился хэш (новые записи выше прошлого максимума ключа - это новые
+# куски). Таблицы с неизменным CHECKSUM TABLE даже не читаются. Файлы - JSONL,
+# сжатый gzip или zstd: с SD-карты Orange Pi за час уходят килобайты, а не дамп целиком
+def backup_extension():
+    if BACKUP_COMPRESSION == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Для OREX_BACKUP_COMPRESSION=zstd нужен пакет zstandard')
+        return '.jsonl.zst'
+    return '.jsonl.gz'
+
+def open_backup_file(path, mode):
+    """Сжатый файл бэкапа в текстовом режиме ('r' или 'w'), формат - по расширению"""
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f'Для чтения {path} нужен пакет zstandard')
+        cctx = zstandard.ZstdCompressor(level=BACKUP_COMPRESS_LEVEL) if mode == 'w' else None
+        return zstandard.open(path, mode + 't', cctx=cctx, encoding='utf-8')
+    return gzip.open(path, mode + 't', compresslevel=BACKUP_COMPRESS_LEVEL, encoding='utf-8')
+
+def read_backup_manifest(backup_dir):
+    try:
+        with open(os.path.join(backup_dir, BACKUP_MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'backups': []}
+
+def write_backup_manifest(backup_dir, manifest):
+    """Манифест заменяется целиком; читать его может группа веб-приложения (страница бэкапов)"""
+    path = os.path.join(backup_dir, BACKUP_MANIFEST)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.chmod(path + '.tmp', 0o640)
+    os.replace(path + '.tmp', path)
+
+@contextmanager
+def backup_lock(backup_dir):
+    """Один бэкап за раз (таймер мог запустить следующий, пока идет проверка)"""
+    with open(os.path.join(backup_dir, '.lock'), 'w') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RuntimeError('Бэкап уже выполняется')
+        yield
+
+def backup_value(value):
+    """Значение для JSONL бэкапа: двоичные данные - в base64, остальное как в JSON-ответах"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'b64': base64.b64encode(bytes(value)).decode('ascii')}
+    return json_value(value)
+
+def restore_value(value):
+    return base64.b64decode(value['b64']) if isinstance(value, dict) else value
+
+# Счетчик AUTO_INCREMENT в SHOW CREATE TABLE растет с каждой вставкой - это не изменение структуры
+# (при восстановлении InnoDB сам продолжит счетчик после наибольшего ключа)
+CREATE_AUTO_INCREMENT_RE = re.compile(r'\s*AUTO_INCREMENT=\d+')
+
+def table_ddl(create):
+    """DDL таблицы без текущего значения AUTO_INCREMENT"""
+    return CREATE_AUTO_INCREMENT_RE.sub('', create) if create else create
+
+def backup_table_info(conn, table_name):
+    """Колонки, первичный ключ и DDL таблицы; куски режутся по ключу, только если он один и целый"""
+    inspector = inspect(conn)
+    columns = inspector.get_columns(table_name)
+    primary_key = inspector.get_pk_constraint(table_name).get('constrained_columns') or []
+    chunk_key = None
+    if len(primary_key) == 1:
+        column = next(col for col in columns if col['name'] == primary_key[0])
+        try:
+            if column['type'].python_type is int:
+                chunk_key = primary_key[0]
+        except NotImplementedError:
+            pass
+    create = None
+    if conn.dialect.name in ('mysql', 'mariadb'):
+        create = table_ddl(conn.execute(text(f"SHOW CREATE TABLE `{table_name}`")).fetchone()[1])
+    return {'columns': [col['name'] for col in columns], 'primary_key': primary_key,
+            'chunk_key': chunk_key, 'create': create}
+
+def backup_schema_changed(base_schema, schema):
+    """Изменилась ли структура таблиц со времени полного снимка.
+    DDL в манифестах прежних версий записан вместе с AUTO_INCREMENT - он отбрасывается и там"""
+    for name, info in schema.items():
+        base_info = base_schema.get(name)
+        if base_info is None or dict(base_info, create=table_ddl(base_info.get('create'))) != info:
+            return True
+    return False
+
+def table_checksums(conn, table_names):
+    """CHECKSUM TABLE по всем таблицам; у SQLite его нет - такие таблицы читаются каждый раз"""
+    if conn.dialect.name not in ('mysql', 'mariadb') or not table_names:
+        return {}
+    result = conn.execute(text(f"CHECKSUM TABLE {', '.join(f'`{name}`' for name in table_names)}"))
+    return {row[0].split('.', 1)[-1]: row[1] for row in result}
+
+def iter_backup_chunks(conn, table_name, info):
+    """(номер куска, строки JSONL, последний ключ) по порядку ключа.
+    
+    Таблица без целого ключа - один кусок 0 (такие таблицы - справочники, они небольшие).
+    """
+    columns = info['columns']
+    chunk_key = info['chunk_key']
+    order = f" ORDER BY `{chunk_key}`" if chunk_key else ''
+    result = conn.execution_options(stream_results=True, yield_per=STREAM_BATCH_SIZE).execute(
+        text(f"SELECT {', '.join(f'`{name}`' for name in columns)} FROM `{table_name}`{order}"))
+    key_index = columns.index(chunk_key) if chunk_key else None
+    chunk_of = (lambda row: row[key_index] // BACKUP_CHUNK_ROWS) if chunk_key else (lambda row: 0)
+    for chunk, rows in itertools.groupby(result, key=chunk_of):
+        rows = list(rows)
+        lines = [json.dumps([backup_value(value) for value in row], ensure_ascii=False, separators=(',', ':'))
+                 for row in rows]
+        yield chunk, lines, rows[-1][key_index] if chunk_key else None
+
+def chunk_digest(lines):
+    return hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest()
+
+def backup_table(conn, table_name, info, path, previous_chunks=None):
+    """Пишет в path куски таблицы, которых нет в previous_chunks (все - для полного снимка).
+    
+    Перед строками куска в файле идет заголовок {"chunk": N}; удаленный кусок - заголовок без строк.
+    Возвращает карту кусков {номер: [строк, хэш]}, число записанных кусков и максимальный ключ.
+    """
+    chunks = {}
+    written = 0
+    watermark = None
+    with open_backup_file(path, 'w') as f:
+        for chunk, lines, last_key in iter_backup_chunks(conn, table_name, info):
+            key = str(chunk)
+            chunks[key] = [len(lines), chunk_digest(lines)]
+            watermark = last_key
+            if previous_chunks is not None and previous_chunks.get(key) == chunks[key]:
+                continue
+            f.write(json.dumps({'chunk': chunk}) + '\n')
+            f.write('\n'.join(lines) + '\n')
+            written += 1
+        for key in previous_chunks or ():
+            if key not in chunks:
+                f.write(json.dumps({'chunk': int(key)}) + '\n')
+                written += 1
+    return chunks, written, watermark
+
+def run_backup(engine, backup_dir, full=False):
+    """Полный или инкрементальный бэкап всех таблиц БД, возвращает запись манифеста.
+    
+    Полный снимок делается, если его еще нет, прошлому больше BACKUP_FULL_INTERVAL
+    или изменилась структура таблиц (инкрементальный накатывается на структуру снимка).
+    """
+    started = time.time()
+    manifest = read_backup_manifest(backup_dir)
+    previous = manifest['backups'][-1] if manifest['backups'] else None
+    base = next((b for b in manifest['backups'] if previous and b['id'] == previous['base']), None)
+    full = full or base is None or started - base['created'] >= BACKUP_FULL_INTERVAL
+    
+    backup_id = datetime.fromtimestamp(started).strftime('%Y-%m-%d_%H-%M-%S')
+    if any(b['id'] == backup_id for b in manifest['backups']):
+        # Бэкап вне очереди в ту же секунду, что и предыдущий
+        backup_id += f"-{sum(1 for b in manifest['backups'] if b['id'].startswith(backup_id))}"
+    part_dir = os.path.join(backup_dir, backup_id + '.part')
+    os.makedirs(part_dir)
+    try:
+        with engine.connect() as conn:
+            table_names = inspect(conn).get_table_names()
+            # CHECKSUM - до начала снимка: изменение между ними попадет в следующий бэкап, а не потеряется
+            checksums = table_checksums(conn, table_names)
+            conn.commit()
+            if conn.dialect.name in ('mysql', 'mariadb'):
+                conn.execute(text("START TRANSACTION WITH CONSISTENT SNAPSHOT"))
+            schema = {name: backup_table_info(conn, name) for name in table_names}
+            if not full and backup_schema_changed(base['schema'], schema):
+                logger.info("Backup: table structure changed, taking a full snapshot")
+                full = True
+            
+            tables = {}
+            for index, table_name in enumerate(table_names):
+                checksum = checksums.get(table_name)
+                previous_table = None if full else previous['tables'].get(table_name)
+                if previous_table and checksum is not None and checksum == previous_table['checksum']:
+                    tables[table_name] = dict(previous_table, file=None, written=0)
+                    continue
+                
+                filename = f"{index:03d}{backup_extension()}"
+                path = os.path.join(part_dir, filename)
+                chunks, written, watermark = backup_table(
+                    conn, table_name, schema[table_name], path,
+                    previous_table['chunks'] if previous_table else None)
+                if not written and not full:
+                    os.remove(path)
+                    filename = None
+                else:
+                    os.chmod(path, 0o600)
+                tables[table_name] = {
+                    'file': filename, 'checksum': checksum, 'chunks': chunks, 'written': written,
+                    'rows': sum(count for count, _ in chunks.values()), 'watermark': watermark,
+                }
+            conn.rollback()
+        
+        backup_path = os.path.join(backup_dir, backup_id)
+        os.rename(part_dir, backup_path)
+    except BaseException:
+        shutil.rmtree(part_dir, ignore_errors=True)
+        raise
+    
+    entry = {
+        'id': backup_id, 'kind': 'full' if full else 'incremental', 'base': backup_id if full else base['id'],
+        'created': started, 'duration': round(time.time() - started, 1),
+        'size': sum(os.path.getsize(os.path.join(backup_path, name)) for name in os.listdir(backup_path)),
+        'tables': tables, 'verified': None,
+    }
+    if full:
+        entry['schema'] = schema
+    manifest['backups'].append(entry)
+    prune_backups(backup_dir, manifest)
+    write_backup_manifest(backup_dir, manifest)
+    logger.info(f"Backup {backup_id} ({entry['kind']}): {sum(1 for t in tables.values() if t['file'])} "
+                f"of {len(tables)} table(s) written, {entry['size']} bytes, {entry['duration']} s")
+    return entry
+
+def prune_backups(backup_dir, manifest):
+    """Оставляет BACKUP_KEEP_FULL последних цепочек, остальные удаляет с диска"""
+    fulls = [b['id'] for b in manifest['backups'] if b['kind'] == 'full']
+    keep = set(fulls[-BACKUP_KEEP_FULL:])
+    for backup in manifest['backups']:
+        if backup['base'] not in keep:
+            shutil.rmtree(os.path.join(backup_dir, backup['id']), ignore_errors=True)
+            logger.info(f"Backup {backup['id']} removed")
+    manifest['backups'] = [b for b in manifest['backups'] if b['base'] in keep]
+
+def backup_chain(manifest, backup_id=None):
+    """Записи манифеста, которые накатываются для восстановления на момент backup_id (по умолчанию - последний)"""
+    backups = manifest['backups']
+    target = backups[-1] if backups and backup_id is None else \
+        next((b for b in backups if b['id'] == backup_id), None)
+    if target is None:
+        raise ValueError(f"Бэкап {backup_id or ''} не найден")
+    return [b for b in backups if b['base'] == target['base'] and b['created'] <= target['created']]
+
+def create_restore_table(conn, table_name, info):
+    if conn.dialect.name in ('mysql', 'mariadb') and info['create']:
+        conn.exec_driver_sql(info['create'])
+        return
+    # Колонки без типа: SQLite хранит значения ровно такими, как они записаны в бэкапе
+    columns = [f"`{name}`" for name in info['columns']]
+    if info['primary_key']:
+        columns.append(f"PRIMARY KEY ({', '.join(f'`{name}`' for name in info['primary_key'])})")
+    conn.exec_driver_sql(f"CREATE TABLE `{table_name}` ({', '.join(columns)})")
+
+def restore_backup_file(conn, table_name, info, path):
+    """Накатывает файл бэкапа: каждый кусок из файла целиком заменяет такой же кусок таблицы"""
+    columns = info['columns']
+    insert = text(f"INSERT INTO `{table_name}` ({', '.join(f'`{name}`' for name in columns)}) "
+                  f"VALUES ({', '.join(f':p{i}' for i in range(len(columns)))})")
+    chunk_key = info['chunk_key']
+    batch = []
+    
+    def flush():
+        if batch:
+            conn.execute(insert, batch)
+            batch.clear()
+    
+    with open_backup_file(path, 'r') as f:
+        for line in f:
+            value = json.loads(line)
+            if isinstance(value, list):
+                batch.append({f'p{i}': restore_value(item) for i, item in enumerate(value)})
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    flush()
+                continue
+            flush()
+            if chunk_key:
+                start = value['chunk'] * BACKUP_CHUNK_ROWS
+                conn.execute(text(f"DELETE FROM `{table_name}` WHERE `{chunk_key}` >= :start AND `{chunk_key}` < :end"),
+                             {'start': start, 'end': start + BACKUP_CHUNK_ROWS})
+            else:
+                conn.execute(text(f"DELETE FROM `{table_name}`"))
+    flush()
+
+def restore_backup(engine, backup_dir, backup_id=None):
+    """Восстанавливает бэкап в пустую БД engine (SQLite или MariaDB), возвращает цепочку записей"""
+    chain = backup_chain(read_backup_manifest(backup_dir), backup_id)
+    schema = chain[0]['schema']
+    tables = chain[-1]['tables']
+    with engine.begin() as conn:
+        existing = set(inspect(conn).get_table_names()) & set(tables)
+        if existing:
+            raise ValueError(f"В целевой БД уже есть таблицы: {', '.join(sorted(existing))}")
+        if conn.dialect.name in ('mysql', 'mariadb'):
+            conn.execute(text("SET FOREIGN_KEY_CHECKS = 0"))
+        for table_name in tables:
+            create_restore_table(conn, table_name, schema[table_name])
+        for backup in chain:
+            for table_name, table in backup['tables'].items():
+                if table['file'] and table_name in tables:
+                    restore_backup_file(conn, table_name, schema[table_name],
+                                        os.path.join(backup_dir, backup['id'], table['file']))
+    return chain
+
+def verify_backup(backup_dir, backup_id=None, url=None):
+    """Восстанавливает бэкап во временную SQLite (или в пустую БД url) и сверяет куски с манифестом.
+    
+    Результат записывается в манифест - его показывает страница бэкапов. Возвращает список расхождений.
+    """
+    work_dir = None
+    if url is None:
+        work_dir = tempfile.mkdtemp(prefix='orex-verify-')
+        url = f"sqlite:///{os.path.join(work_dir, 'verify.sqlite')}"
+    engine = create_engine(url)
+    errors = []
+    try:
+        chain = restore_backup(engine, backup_dir, backup_id)
+        schema = chain[0]['schema']
+        with engine.connect() as conn:
+            for table_name, table in chain[-1]['tables'].items():
+                chunks = {str(chunk): [len(lines), chunk_digest(lines)]
+                          for chunk, lines, _ in iter_backup_chunks(conn, table_name, schema[table_name])}
+                if chunks != table['chunks']:
+                    errors.append(table_name)
+    except Exception as e:
+        errors.append(str(e))
+        chain = None
+    finally:
+        engine.dispose()
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    manifest = read_backup_manifest(backup_dir)
+    target_id = chain[-1]['id'] if chain else backup_id or (manifest['backups'] or [{}])[-1].get('id')
+    for backup in manifest['backups']:
+        if backup['id'] == target_id:
+            backup['verified'] = {'time': time.time(), 'ok': not errors, 'errors': errors}
+    write_backup_manifest(backup_dir, manifest)
+    if errors:
+        logger.error(f"Backup {target_id} verification failed: {', '.join(errors)}")
+    else:
+        logger.info(f"Backup {target_id} verified")
+    return errors
+
+def last_verified(manifest):
+    times = [b['verified']['time'] for b in manifest['backups'] if b.get('verified')]
+    return max(times, default=0)
+
+def read_backup_config(path):
+    """Настройки из конфига setup-backup.sh (строки KEY="value")"""
+    config = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            name, sep, value = line.strip().partition('=')
+            if sep and not name.startswith('#'):
+                config[name] = value.strip().strip('"')
+    return config
+
+def backup_status(backup_dir):
+    """Сводка для страницы бэкапов: записи манифеста (новые сверху), общий размер, место на диске"""
+    manifest = read_backup_manifest(backup_dir)
+    backups = []
+    for backup in reversed(manifest['backups']):
+        tables = backup['tables'].values()
+        verified = backup.get('verified')
+        backups.append({
+            'id': backup['id'], 'kind': backup['kind'], 'size': backup['size'], 'duration': backup['duration'],
+            'tables': len(tables), 'written': sum(1 for table in tables if table['file']),
+            'rows': sum(table['rows'] for table in tables),
+            'verified': None if not verified else {
+                'ok': verified['ok'], 'errors': verified['errors'],
+                'time': datetime.fromtimestamp(verified['time']).strftime('%Y-%m-%d %H:%M'),
+            },
+        })
+    last = manifest['backups'][-1]['created'] if manifest['backups'] else None
+    return {
+        'backups': backups,
+        'total_size': sum(backup['size'] for backup in backups),
+        'disk': shutil.disk_usage(backup_dir) if os.path.isdir(backup_dir) else None,
+        'last_age_hours': round((time.time() - last) / 3600, 1) if last else None,
+    }
+
+def backup_main(argv):
+    """Командная строка: python orex.py backup [run|verify|restore|status] (запускает таймер orex-backup)"""
+    parser = argparse.ArgumentParser(prog='orex.py backup', description='Резервные копии таблиц orex')
+    parser.add_argument('action', nargs='?', default='run', choices=['run', 'verify', 'restore', 'status'])
+    parser.add_argument('--full', action='store_true', help='полный снимок вне очереди')
+    parser.add_argument('--verify', action='store_true', help='проверить восстановление сразу после бэкапа')
+    parser.add_argument('--id', help='бэкап для verify/restore (по умолчанию последний)')
+    parser.add_argument('--to', help='SQLAlchemy URL пустой БД для restore/verify (verify по умолчанию - временная SQLite)')
+    parser.add_argument('--db-url', help='SQLAlchemy URL исходной БД (по умолчанию - из конфига)')
+    parser.add_argument('--config', default=BACKUP_CONFIG, help='конфиг setup-backup.sh')
+    parser.add_argument('--dir', help='папка бэкапов (по умолчанию - из конфига или OREX_BACKUP_DIR)')
+    args = parser.parse_args(argv)
+    
+    config = read_backup_config(args.config) if os.path.exists(args.config) else {}
+    backup_dir = args.dir or config.get('BACKUP_DIR') or BACKUP_DIR
+    os.makedirs(backup_dir, mode=0o750, exist_ok=True)
+    
+    if args.action == 'status':
+        for backup in backup_status(backup_dir)['backups']:
+            verified = backup['verified']
+            print(f"{backup['id']}  {backup['kind']:<11}  {backup['size']:>12} B  "
+                  f"{backup['written']}/{backup['tables']} tables  "
+                  f"{'verified' if verified and verified['ok'] else 'FAILED' if verified else ''}")
+        return 0
+    
+    with backup_lock(backup_dir):
+        if args.action == 'restore':
+            if not args.to:
+                parser.error('для restore нужен --to')
+            restore_backup(create_engine(args.to), backup_dir, args.id)
+            return 0
+        if args.action == 'verify':
+            return 1 if verify_backup(backup_dir, args.id, args.to) else 0
+        
+        if args.db_url:
+            engine = create_engine(args.db_url)
+        else:
+            engine = create_user_engine(config.get('DB_HOST', 'localhost'), config['DB_USER'],
+                                        config['DB_PASSWORD'], config['DB_NAME'])
+        try:
+            entry = run_backup(engine, backup_dir, full=args.full)
+        finally:
+            engine.dispose()
+        manifest = read_backup_manifest(backup_dir)
+        if args.verify or entry['kind'] == 'full' or time.time() - last_verified(manifest) >= BACKUP_VERIFY_INTERVAL:
+            return 1 if verify_backup(backup_dir, entry['id'], args.to) else 0
+    return 0
+
+@orex.route('/orex-ws/login', methods=['GET', 'POST'])
+def login():
+    ip = get_remote_address()
+    user_agent = request.user_agent.string
+    
+    # Проверка безопасности для GET запроса
+    if request.method == 'GET':
+        # Проверяем бан по IP
+        if is_ip_banned(ip):
+            return f"Доступ запрещен: IP заблокирован", 403
+        
+        # Проверяем браузер
+        if not check_browser_allowed(user_agent):
+            return "Доступ запрещен: Неподдерживаемый браузер", 403
+        
+        return render_template('login.html')
+    
+    # Обработка POST запроса
+    fingerprint = request.form.get('fingerprint', '')
+    
+    # Проверяем бан по IP
+    if is_ip_banned(ip):
+        log_login_attempt(ip, fingerprint, False, "Banned IP")
+        return "Доступ запрещен: IP заблокирован", 403
+    
+    # Проверяем браузер
+    if not check_browser_allowed(user_agent):
+        log_login_attempt(ip, fingerprint, False, "Invalid browser")
+        return "Доступ запрещен: Неподдерживаемый браузер", 403
+    
+    # Проверяем попытки входа
+    if login_failures(ip) >= LOGIN_MAX_FAILURES:
+        add_to_blacklist(ip, "Too many failed attempts")
+        log_login_attempt(ip, fingerprint, False, "Too many attempts")
         return "Слишком много неудачных попыток. Ваш IP заблокирован.", 403
     
     # Проверяем белый список (если IP уже есть в нем)
-    whitelist = read_security_list(SECURITY_WHITELIST)
-    ip_in_whitelist = any(ip in entry for entry in whitelist)
+    ip_in_whitelist = is_ip_whitelisted(ip)
     
     if ip_in_whitelist and not check_whitelist(ip, fingerprint):
         log_login_attempt(ip, fingerprint, False, "Fingerprint mismatch")
@@ -302,21 +3519,27 @@ def login():
         database = request.form['database']
         
         # Пробуем подключиться
-        engine = create_engine(
-            f"mysql+pymysql://{user}:{password}@{host}/{database}"
-        )
-        with engine.connect() as conn:
-            conn.execute(text("SELECT 1"))  # Простейший запрос для проверки
+        engine = create_user_engine(host, user, password, database)
+        try:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))  # Простейший запрос для проверки
+        except Exception:
+            engine.dispose()
+            raise
         
         # Сбрасываем счетчик попыток
-        if attempt_key in login_attempts:
-            del login_attempts[attempt_key]
+        reset_login_failures(ip)
         
         # Добавляем в белый список, если IP еще не там
         if not ip_in_whitelist:
             add_to_whitelist(ip, fingerprint)
         
-        # Сохраняем в сессию
+        # Повторный вход в той же сессии - старый движок больше не нужен
+        forget_session_engine(session.get('engine_key'))
+        
+        # Сохраняем в сессию только ключ, данные подключения остаются на сервере
+        session['engine_key'] = register_engine(engine)
+        get_credential_store().put(session['engine_key'], [host, user, password, database])
         session['logged_in'] = True
         session['fingerprint'] = fingerprint
         session['ip'] = ip
@@ -326,20 +3549,416 @@ def login():
     
     except Exception as e:
         # Увеличиваем счетчик попыток
-        login_attempts[attempt_key] = login_attempts.get(attempt_key, 0) + 1
+        record_login_failure(ip)
         logger.error(f"Login error: {str(e)}")
         log_login_attempt(ip, fingerprint, False, str(e))
         return render_template('login.html', error=str(e))
 
 @orex.route('/orex-ws/logout')
 def logout():
-    global engine
     session.pop('logged_in', None)
-    engine = None
+    forget_session_engine(session.pop('engine_key', None))
     return redirect(url_for('login'))
 
-@orex.route('/orex-ws')
-def base():
+@orex.route('/orex-ws')
+def base():
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    
+    # Дополнительная проверка безопасности
+    ip = get_remote_address()
+    fingerprint = session.get('fingerprint', '')
+    
+    if ip != session.get('ip'):
+        session.clear()
+        return redirect(url_for('login'))
+
+    if not check_whitelist(ip, fingerprint):
+        session.clear()
+        return redirect(url_for('login'))
+    
+    try:
+        # Служебные таблицы orex (сводки отчетов, счетчики и связи исходящих) в списке не показываем
+        tables = [name for name in get_table_names()
+                  if name not in (REPORT_SUMMARY_TABLE, REPORT_STATE_TABLE, OUTGOING_COUNTERS_TABLE,
+                                  OUTGOING_LINKS_TABLE)]
+        return render_template('base.html', tables=tables)
+    
+    except Exception as e:
+        logger.error(f"Base error: {str(e)}")
+        return render_template('error.html', error=str(e))
+
+@orex.route('/orex-ws/table', methods=['GET', 'POST'])
+def show_table():
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    
+    # Дополнительная проверка безопасности
+    ip = get_remote_address()
+    fingerprint = session.get('fingerprint', '')
+    
+    if ip != session.get('ip'):
+        session.clear()
+        return redirect(url_for('login'))
+
+    if not check_whitelist(ip, fingerprint):
+        session.clear()
+        return redirect(url_for('login'))
+    
+    table_name = request.args.get('name')
+    if not table_name:
+        return redirect(url_for('base'))
+    
+    try:
+        schema = get_table_schema(table_name)
+        columns = schema['column_names']
+        primary_key = schema['primary_key'] or columns[0]
+        
+        # Получаем список шаблонов
+        templates = get_template_list()
+        
+        if request.method == 'POST':
+            # Обработка загрузки шаблона
+            if 'template_file' in request.files:
+                file = request.files['template_file']
+                if file.filename == '':
+                    flash('Не выбран файл для загрузки', 'danger')
+                elif not allowed_file(file.filename):
+                    flash('Разрешены только файлы .odt', 'danger')
+                else:
+                    # Генерируем уникальное имя файла
+                    filename = secure_filename(file.filename)
+                    unique_name = f"{uuid.uuid4().hex[:8]}_{filename}"
+                    save_path = os.path.join(PRINT_TEMPLATES_DIR, unique_name)
+                    
+                    try:
+                        file.save(save_path)
+                        flash(f'Шаблон "{filename}" успешно загружен!', 'success')
+                        logger.info(f"Template uploaded: {save_path}")
+                        # Возвращаемся на ту же страницу
+                        return redirect(url_for('show_table', name=table_name))
+                    except Exception as e:
+                        logger.error(f"Template save error: {str(e)}")
+                        flash(f'Ошибка при сохранении файла: {str(e)}', 'danger')
+            
+            # Ответ на письмо без JS (с JS страница ставит задачу через start_document_job).
+            # Из кэша документ отдается сразу, генерация идет в фоновой задаче
+            elif 'row_id' in request.form:
+                row_id = request.form['row_id']
+                template_name = request.form.get('template')
+                fmt = 'pdf' if request.form.get('format') == 'pdf' else 'odt'
+                
+                template_path = os.path.join(PRINT_TEMPLATES_DIR, os.path.basename(template_name or ''))
+                
+                if not template_name or not os.path.exists(template_path):
+                    flash(f'Шаблон {template_name} не найден', 'danger')
+                elif fmt == 'pdf' and not pdf_available():
+                    flash('LibreOffice не установлен - PDF недоступен', 'danger')
+                else:
+                    try:
+                        logger.debug(f"Processing template: {template_path}")
+                        rule = get_reply_rule(table_name)
+                        
+                        # Только нужная строка и только колонки, которые использует шаблон
+                        with get_engine().connect() as conn:
+                            rows = fetch_reply_rows(conn, table_name, schema, template_path, [row_id], rule)
+                        
+                        if not rows:
+                            flash('Запись не найдена', 'danger')
+                        else:
+                            actor = {'ip': ip, 'user': get_engine().url.username}
+                            documents = outgoing_records(get_engine(), table_name, rows, primary_key, rule,
+                                                         actor, renew=request.form.get('new_number') == '1')
+                            filename = f'response_{row_id}.{fmt}'
+                            
+                            # Готовый файл из кэша - сервер отдает его через sendfile
+                            document_path = document_cache.get(document_cache_key(template_path, documents[0]), fmt)
+                            if document_path is not None:
+                                return send_file(
+                                    os.path.abspath(document_path),
+                                    as_attachment=True,
+                                    download_name=filename,
+                                    mimetype=DOCUMENT_MIMETYPES[fmt]
+                                )
+                            
+                            job_id = submit_job('document', 1, filename, DOCUMENT_MIMETYPES[fmt],
+                                                write_reply_files, template_path, documents, primary_key, fmt)
+                            logger.info(f"Document job {job_id}: {filename} from {template_name}")
+                            return redirect(url_for('job_page', job_id=job_id, table=table_name))
+                    except Exception as e:
+                        logger.error(f"Template processing error: {str(e)}")
+                        flash(f'Ошибка обработки шаблона: {str(e)}', 'danger')
+        
+        # Полная таблица (для печати) - только по явному запросу.
+        # Отдаем ее потоком, не собирая все строки и весь HTML в памяти
+        if request.args.get('all') == '1':
+            with get_engine().connect() as conn:
+                max_pk = get_max_pk(conn, table_name, primary_key)
+            
+            page = stream_template('table.html',
+                                   table_name=table_name,
+                                   columns=columns,
+                                   rows=iter_table_rows(get_engine(), table_name, primary_key),
+                                   primary_key=primary_key,
+                                   templates=templates,
+                                   pdf_enabled=pdf_available(),
+                                   outgoing_rule=has_reply_rule(table_name),
+                                   max_pk=max_pk,
+                                   show_all=True,
+                                   page_size=TABLE_PAGE_SIZE,
+                                   next_after=None,
+                                   columns_meta=schema['columns'],
+                                   filters={})
+            return Response(stream_with_context(iter_chunks(page)), mimetype='text/html')
+        
+        def render_page():
+            limit = get_page_size(request.args.get('limit'))
+            after = request.args.get('after') or None
+            filters = get_table_filters(request.args, schema)
+            
+            with get_engine().connect() as conn:
+                rows, next_after = search_rows_page(conn, table_name, schema, filters, after, limit)
+                max_pk = get_max_pk(conn, table_name, primary_key)
+            
+            return render_template('table.html',
+                                  table_name=table_name,
+                                  columns=columns,
+                                  columns_meta=schema['columns'],
+                                  rows=rows,
+                                  primary_key=primary_key,
+                                  templates=templates,
+                                  pdf_enabled=pdf_available(),
+                                  outgoing_rule=has_reply_rule(table_name),
+                                  max_pk=max_pk,
+                                  show_all=False,
+                                  page_size=limit,
+                                  next_after=next_after,
+                                  filters=filters)
+        
+        return cached_table_page('page', table_name, schema, render_page)
+    
+    except Exception as e:
+        logger.error(f"Show table error: {str(e)}")
+        return render_template('error.html', error=str(e))
+
+@orex.route('/orex-ws/table/rows', methods=['GET'])
+def table_rows():
+    """Следующая страница строк таблицы в JSON (для подгрузки на странице таблицы)"""
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'message': 'Требуется авторизация'}), 401
+    
+    # Дополнительная проверка безопасности
+    ip = get_remote_address()
+    fingerprint = session.get('fingerprint', '')
+    
+    if ip != session.get('ip'):
+        session.clear()
+        return jsonify({'success': False, 'message': 'Security error'}), 403
+
+    if not check_whitelist(ip, fingerprint):
+        session.clear()
+        return jsonify({'success': False, 'message': 'Security error'}), 403
+    
+    table_name = request.args.get('name')
+    if not table_name:
+        return jsonify({'success': False, 'message': 'Не указана таблица'}), 400
+    
+    try:
+        schema = get_table_schema(table_name)
+        columns = schema['column_names']
+        primary_key = schema['primary_key'] or columns[0]
+        
+        def render_rows():
+            limit = get_page_size(request.args.get('limit'))
+            after = request.args.get('after') or None
+            filters = get_table_filters(request.args, schema)
+            
+            with get_engine().connect() as conn:
+                rows, next_after = search_rows_page(conn, table_name, schema, filters, after, limit)
+                max_pk = get_max_pk(conn, table_name, primary_key)
+            
+            # Готовая разметка строк - та же, что и на самой странице
+            html = render_template('table_rows.html',
+                                   table_name=table_name,
+                                   columns=columns,
+                                   rows=rows,
+                                   primary_key=primary_key,
+                                   templates=get_template_list(),
+                                   max_pk=max_pk)
+            
+            return jsonify({
+                'success': True,
+                'rows': [{key: json_value(value) for key, value in row.items()} for row in rows],
+                'html': html,
+                'next_after': json_value(next_after)
+            })
+        
+        return cached_table_page('rows', table_name, schema, render_rows)
+    
+    except Exception as e:
+        logger.error(f"Table rows error: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@orex.route('/orex-ws/export', methods=['GET'])
+def export_table():
+    """Выгрузка всей таблицы в CSV или ODS потоком"""
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    
+    # Дополнительная проверка безопасности
+    ip = get_remote_address()
+    fingerprint = session.get('fingerprint', '')
+    
+    if ip != session.get('ip'):
+        session.clear()
+        return redirect(url_for('login'))
+
+    if not check_whitelist(ip, fingerprint):
+        session.clear()
+        return redirect(url_for('login'))
+    
+    table_name = request.args.get('name')
+    export_format = request.args.get('format', 'csv')
+    if not table_name:
+        return redirect(url_for('base'))
+    
+    try:
+        schema = get_table_schema(table_name)
+        columns = schema['column_names']
+        primary_key = schema['primary_key'] or columns[0]
+        
+        rows = iter_table_rows(get_engine(), table_name, primary_key)
+        
+        if export_format == 'ods':
+            return Response(stream_with_context(iter_ods_export(table_name, columns, rows)),
+                            mimetype='application/vnd.oasis.opendocument.spreadsheet',
+                            headers=attachment_headers(f'{table_name}.ods'))
+        
+        return Response(stream_with_context(iter_csv_export(columns, rows)),
+                        mimetype='text/csv; charset=utf-8',
+                        headers=attachment_headers(f'{table_name}.csv'))
+    
+    except Exception as e:
+        logger.error(f"Export error: {str(e)}")
+        flash(f'Ошибка выгрузки: {str(e)}', 'danger')
+        return redirect(url_for('show_table', name=table_name))
+
+@orex.route('/orex-ws/jobs/documents', methods=['POST'])
+def start_document_job():
+    """Ставит генерацию ответов в фоновую очередь: одно письмо - ODT, несколько - ZIP"""
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'message': 'Требуется авторизация'}), 401
+    
+    # Дополнительная проверка безопасности
+    ip = get_remote_address()
+    fingerprint = session.get('fingerprint', '')
+    
+    if ip != session.get('ip'):
+        session.clear()
+        return jsonify({'success': False, 'message': 'Security error'}), 403
+
+    if not check_whitelist(ip, fingerprint):
+        session.clear()
+        return jsonify({'success': False, 'message': 'Security error'}), 403
+    
+    table_name = request.form.get('table_name')
+    template_name = request.form.get('template')
+    row_ids = [row_id for row_id in request.form.getlist('row_ids') if row_id]
+    fmt = 'pdf' if request.form.get('format') == 'pdf' else 'odt'
+    
+    if not table_name or not template_name or not row_ids:
+        return jsonify({'success': False, 'message': 'Не выбраны письма или шаблон'}), 400
+    
+    if len(row_ids) > BATCH_MAX_ROWS:
+        return jsonify({'success': False,
+                        'message': f'За один раз можно сформировать не больше {BATCH_MAX_ROWS} ответов'}), 400
+    
+    try:
+        template_path = os.path.join(PRINT_TEMPLATES_DIR, os.path.basename(template_name))
+        if not os.path.exists(template_path):
+            return jsonify({'success': False, 'message': f'Шаблон {template_name} не найден'}), 404
+        
+        schema = get_table_schema(table_name)
+        primary_key = schema['primary_key'] or schema['column_names'][0]
+        
+        # Правило и структуру таблицы исходящих берем здесь - в задаче нет сессии
+        rule = get_reply_rule(table_name)
+        
+        # Шаблон разбирается здесь же: ошибку в нем видно сразу, а не через статус задачи
+        with get_engine().connect() as conn:
+            rows = fetch_reply_rows(conn, table_name, schema, template_path, row_ids, rule)
+        
+        if not rows:
+            return jsonify({'success': False, 'message': 'Выбранные записи не найдены'}), 404
+        
+        if fmt == 'pdf' and not pdf_available():
+            return jsonify({'success': False, 'message': 'LibreOffice не установлен - PDF недоступен'}), 400
+        
+        actor = {'ip': ip, 'user': get_engine().url.username}
+        renew = request.form.get('new_number') == '1'
+        job_args = (get_engine(), table_name, template_path, rows, primary_key, rule, actor, fmt, renew)
+        
+        if len(rows) == 1:
+            job_id = submit_job('document', 1, f'response_{rows[0][primary_key]}.{fmt}',
+                                DOCUMENT_MIMETYPES[fmt], write_replies, *job_args)
+        else:
+            job_id = submit_job('documents_zip', len(rows), f'responses_{table_name}.zip', 'application/zip',
+                                write_replies, *job_args)
+        
+        logger.info(f"Document job {job_id}: {len(rows)} documents from {template_name}")
+        return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('job_status', job_id=job_id)})
+    
+    except Exception as e:
+        logger.error(f"Document job error: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+def get_session_job(job_id):
+    """Задача текущей сессии или None (чужие задачи не показываем)"""
+    job = get_job_store().get(job_id)
+    if job is None or job['owner'] != session.get('fingerprint', ''):
+        return None
+    
+    # Процесс, выполнявший задачу, перезапущен - она уже не завершится
+    if job['status'] in ('queued', 'running') and not process_alive(job['pid']):
+        get_job_store().update(job_id, status='error', error='Задача прервана перезапуском сервера',
+                               finished=time.time())
+        job = get_job_store().get(job_id)
+    return job
+
+@orex.route('/orex-ws/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Статус фоновой задачи (для опроса со страницы)"""
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'message': 'Требуется авторизация'}), 401
+    
+    # Дополнительная проверка безопасности
+    ip = get_remote_address()
+    fingerprint = session.get('fingerprint', '')
+    
+    if ip != session.get('ip'):
+        session.clear()
+        return jsonify({'success': False, 'message': 'Security error'}), 403
+
+    if not check_whitelist(ip, fingerprint):
+        session.clear()
+        return jsonify({'success': False, 'message': 'Security error'}), 403
+    
+    job = get_session_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Задача не найдена'}), 404
+    
+    return jsonify({
+        'success': True,
+        'status': job['status'],
+        'progress': job['progress'],
+        'total': job['total'],
+        'message': job['error'],
+        'download_url': url_for('job_download', job_id=job_id) if job['status'] == 'done' else None
+    })
+
+@orex.route('/orex-ws/jobs/<job_id>/page', methods=['GET'])
+def job_page(job_id):
+    """Страница ожидания фоновой задачи без JS: обновляется сама, пока файл не готов"""
     if not session.get('logged_in'):
         return redirect(url_for('login'))
     
@@ -355,16 +3974,17 @@ def base():
         session.clear()
         return redirect(url_for('login'))
     
-    try:
-        inspector = inspect(engine)
-        return render_template('base.html', tables=inspector.get_table_names())
+    job = get_session_job(job_id)
+    if job is None:
+        return render_template('error.html', error='Задача не найдена')
     
-    except Exception as e:
-        logger.error(f"Base error: {str(e)}")
-        return render_template('error.html', error=str(e))
+    table_name = request.args.get('table')
+    back_url = url_for('show_table', name=table_name) if table_name else url_for('base')
+    return render_template('job.html', job=job, back_url=back_url)
 
-@orex.route('/orex-ws/table', methods=['GET', 'POST'])
-def show_table():
+@orex.route('/orex-ws/jobs/<job_id>/download', methods=['GET'])
+def job_download(job_id):
+    """Готовый файл фоновой задачи"""
     if not session.get('logged_in'):
         return redirect(url_for('login'))
     
@@ -380,91 +4000,14 @@ def show_table():
         session.clear()
         return redirect(url_for('login'))
     
-    table_name = request.args.get('name')
-    if not table_name:
-        return redirect(url_for('base'))
-    
-    try:
-        inspector = inspect(engine)
-        columns = [col['name'] for col in inspector.get_columns(table_name)]
-        primary_keys = inspector.get_pk_constraint(table_name)['constrained_columns']
-        primary_key = primary_keys[0] if primary_keys else columns[0]
-        
-        with engine.connect() as conn:
-            rows = [dict(row) for row in conn.execute(text(f"SELECT * FROM `{table_name}`")).mappings()]
-        
-        # Получаем список шаблонов
-        templates = get_template_list()
-        
-        if request.method == 'POST':
-            # Обработка загрузки шаблона
-            if 'template_file' in request.files:
-                file = request.files['template_file']
-                if file.filename == '':
-                    flash('Не выбран файл для загрузки', 'danger')
-                elif not allowed_file(file.filename):
-                    flash('Разрешены только файлы .odt', 'danger')
-                else:
-                    # Генерируем уникальное имя файла
-                    filename = secure_filename(file.filename)
-                    unique_name = f"{uuid.uuid4().hex[:8]}_{filename}"
-                    save_path = os.path.join(PRINT_TEMPLATES_DIR, unique_name)
-                    
-                    try:
-                        file.save(save_path)
-                        flash(f'Шаблон "{filename}" успешно загружен!', 'success')
-                        logger.info(f"Template uploaded: {save_path}")
-                        # Возвращаемся на ту же страницу
-                        return redirect(url_for('show_table', name=table_name))
-                    except Exception as e:
-                        logger.error(f"Template save error: {str(e)}")
-                        flash(f'Ошибка при сохранении файла: {str(e)}', 'danger')
-            
-            # Генерация ответа на письмо
-            elif 'row_id' in request.form:
-                row_id = request.form['row_id']
-                template_name = request.form.get('template')
-                selected_row = next((row for row in rows if str(row[primary_key]) == row_id), None)
-                
-                if selected_row and template_name:
-                    # Полный путь к шаблону
-                    template_path = os.path.join(PRINT_TEMPLATES_DIR, template_name)
-                    
-                    if not os.path.exists(template_path):
-                        flash(f'Шаблон {template_name} не найден', 'danger')
-                    else:
-                        # Обрабатываем шаблон
-                        try:
-                            logger.debug(f"Processing template: {template_path}")
-                            logger.debug(f"Using data: {selected_row}")
-                            
-                            processed_path, temp_dir = process_odt_template(template_path, selected_row)
-                            
-                            # Отправляем результат
-                            response = send_file(
-                                processed_path,
-                                as_attachment=True,
-                                download_name=f'response_{row_id}.odt',
-                                mimetype='application/vnd.oasis.opendocument.text'
-                            )
-                            
-                            # Удаляем временные файлы после отправки
-                            response.call_on_close(lambda: shutil.rmtree(temp_dir, ignore_errors=True))
-                            return response
-                        except Exception as e:
-                            logger.error(f"Template processing error: {str(e)}")
-                            flash(f'Ошибка обработки шаблона: {str(e)}', 'danger')
-        
-        return render_template('table.html',
-                              table_name=table_name,
-                              columns=columns,
-                              rows=rows,
-                              primary_key=primary_key,
-                              templates=templates)
+    job = get_session_job(job_id)
+    if job is None or job['status'] != 'done' or not os.path.exists(job['path']):
+        return render_template('error.html', error='Файл не найден или уже удален')
     
-    except Exception as e:
-        logger.error(f"Show table error: {str(e)}")
-        return render_template('error.html', error=str(e))
+    return send_file(os.path.abspath(job['path']),
+                     as_attachment=True,
+                     download_name=job['filename'],
+                     mimetype=job['mimetype'])
 
 @orex.route('/orex-ws/vvod', methods=['GET'])
 def vvod():
@@ -503,6 +4046,41 @@ def vvod():
         logger.error(f"Vvod error: {str(e)}")
         return render_template('error.html', error=str(e))
 
+@orex.route('/orex-ws/suggest', methods=['GET'])
+def suggest():
+    """Подсказки для поля ввода: значения колонки, начинающиеся с введенного текста"""
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'message': 'Требуется авторизация'}), 401
+    
+    # Дополнительная проверка безопасности
+    ip = get_remote_address()
+    fingerprint = session.get('fingerprint', '')
+    
+    if ip != session.get('ip'):
+        session.clear()
+        return jsonify({'success': False, 'message': 'Security error'}), 403
+
+    if not check_whitelist(ip, fingerprint):
+        session.clear()
+        return jsonify({'success': False, 'message': 'Security error'}), 403
+    
+    table_name = request.args.get('table')
+    column = request.args.get('column')
+    prefix = request.args.get('q', '')
+    if not table_name or not column:
+        return jsonify({'success': False, 'message': 'Не указана таблица или колонка'}), 400
+
+    try:
+        columns_meta = get_table_metadata(table_name)
+        if not any(col['name'] == column and col['type'] == 'TEXT' for col in columns_meta):
+            return jsonify({'success': False, 'message': 'Подсказки есть только для текстовых колонок'}), 400
+        
+        return jsonify({'success': True, 'suggestions': get_suggest_index(table_name, column).suggest(prefix)})
+    
+    except Exception as e:
+        logger.error(f"Suggest error: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
 @orex.route('/orex-ws/save_record', methods=['POST'])
 def save_record():
     if not session.get('logged_in'):
@@ -527,42 +4105,22 @@ def save_record():
     try:
         # Получаем полную метаинформацию о таблице
         columns_meta = get_table_metadata(table_name)
-        data = {}
         
-        for col in columns_meta:
-            col_name = col['name']
-            form_value = request.form.get(col_name)
-            
-            # Для автоинкрементных полей ничего не делаем
-            if col['autoincrement']:
-                continue
-                
-            # Обработка разных случаев
-            if form_value is None or form_value == '':
-                if col['nullable']:
-                    data[col_name] = None
-                elif col['default'] is not None:
-                    continue
-                else:
-                    flash(f'Поле "{col_name}" обязательно для заполнения', 'danger')
-                    return redirect(url_for('vvod', table=table_name))
-            else:
-                if col['type'] == 'BOOLEAN' or 'галочка' in col_name.lower():
-                    data[col_name] = 1 if form_value == '1' else 0
-                elif col['type'] == 'DATE' and form_value:
-                    data[col_name] = datetime.strptime(form_value, '%Y-%m-%d').date()
-                elif col['type'] == 'DATETIME' and form_value:
-                    data[col_name] = datetime.strptime(form_value, '%Y-%m-%dT%H:%M')
-                else:
-                    data[col_name] = form_value
+        try:
+            data = build_record_data(columns_meta, request.form)
+        except RequiredFieldError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('vvod', table=table_name))
         
         # Строим запрос на вставку
         columns_str = ', '.join([f'`{col}`' for col in data.keys()])
         values_str = ', '.join([f':{col}' for col in data.keys()])
         insert_query = text(f"INSERT INTO `{table_name}` ({columns_str}) VALUES ({values_str})")
         
-        with engine.begin() as conn:
-            conn.execute(insert_query, data)
+        with get_engine().begin() as conn:
+            record_id = conn.execute(insert_query, data).lastrowid
+        table_data_changed(table_name, changes=[(None, data)])
+        audit('record_insert', table=table_name, id=record_id, columns=list(data))
         
         flash('Запись успешно добавлена!', 'success')
         return redirect(f'/orex-ws/table?name={table_name}')
@@ -572,6 +4130,66 @@ def save_record():
         flash(f'Ошибка при сохранении: {str(e)}', 'danger')
         return redirect(url_for('vvod', table=table_name))
 
+@orex.route('/orex-ws/import', methods=['GET', 'POST'])
+def import_records():
+    """Массовый импорт записей из CSV или ODS"""
+    # Файлы импорта больше общего лимита загрузки; werkzeug пишет их во временный файл
+    request.max_content_length = IMPORT_MAX_CONTENT_LENGTH
+    
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    
+    # Дополнительная проверка безопасности
+    ip = get_remote_address()
+    fingerprint = session.get('fingerprint', '')
+    
+    if ip != session.get('ip'):
+        session.clear()
+        return redirect(url_for('login'))
+
+    if not check_whitelist(ip, fingerprint):
+        session.clear()
+        return redirect(url_for('login'))
+    
+    table_name = request.values.get('table')
+    if not table_name:
+        return redirect(url_for('base'))
+    
+    try:
+        columns_meta = get_table_metadata(table_name)
+        result = None
+        
+        if request.method == 'POST':
+            file = request.files.get('import_file')
+            extension = file.filename.rsplit('.', 1)[-1].lower() if file and '.' in file.filename else ''
+            
+            if not file or file.filename == '':
+                flash('Не выбран файл для импорта', 'danger')
+            elif extension not in ('csv', 'ods'):
+                flash('Поддерживаются только файлы .csv и .ods', 'danger')
+            else:
+                rows = iter_csv_rows(file.stream) if extension == 'csv' else iter_ods_rows(file.stream)
+                try:
+                    result = import_rows(get_engine(), table_name, columns_meta, rows,
+                                         skip_errors=request.form.get('skip_errors') == '1',
+                                         dry_run=request.form.get('dry_run') == '1')
+                except (ValueError, RuntimeError, zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+                    flash(f'Ошибка импорта: {str(e)}', 'danger')
+                
+                if result and result['committed'] and result['inserted']:
+                    table_data_changed(table_name)
+                    logger.info(f"Imported {result['inserted']} rows into {table_name} from {file.filename}")
+                    audit('records_import', table=table_name, rows=result['inserted'], file=file.filename)
+        
+        return render_template('import.html',
+                              table_name=table_name,
+                              columns=[col for col in columns_meta if not col['autoincrement']],
+                              result=result)
+    
+    except Exception as e:
+        logger.error(f"Import error: {str(e)}")
+        return render_template('error.html', error=str(e))
+
 @orex.route('/orex-ws/edit', methods=['GET'])
 def edit_record():
     if not session.get('logged_in'):
@@ -601,12 +4219,10 @@ def edit_record():
         visible_columns = [col for col in columns_meta if not col['autoincrement']]
         
         # Определяем первичный ключ
-        inspector = inspect(engine)
-        primary_keys = inspector.get_pk_constraint(table_name)['constrained_columns']
-        primary_key = primary_keys[0] if primary_keys else None
+        primary_key = get_table_schema(table_name)['primary_key']
         
         # Получаем запись для редактирования
-        with engine.connect() as conn:
+        with get_engine().connect() as conn:
             query = text(f"SELECT * FROM `{table_name}` WHERE `{primary_key}` = :id")
             result = conn.execute(query, {'id': row_id})
             record = result.mappings().first()
@@ -659,39 +4275,16 @@ def update_record():
     
     try:
         # Получаем метаданные таблицы
-        columns_meta = get_table_metadata(table_name)
-        inspector = inspect(engine)
-        primary_keys = inspector.get_pk_constraint(table_name)['constrained_columns']
-        primary_key = primary_keys[0] if primary_keys else None
+        schema = get_table_schema(table_name)
+        columns_meta = schema['columns']
+        primary_key = schema['primary_key']
         
-        data = {}
-        for col in columns_meta:
-            col_name = col['name']
-            
-            # Пропускаем автоинкрементные поля и первичный ключ
-            if col['autoincrement'] or col_name == primary_key:
-                continue
-                
-            form_value = request.form.get(col_name)
-            
-            # Обработка значений
-            if form_value is None or form_value == '':
-                if col['nullable']:
-                    data[col_name] = None
-                elif col['default'] is not None:
-                    continue
-                else:
-                    flash(f'Поле "{col_name}" обязательно для заполнения', 'danger')
-                    return redirect(url_for('edit_record', table_name=table_name, row_id=primary_key_value))
-            else:
-                if col['type'] == 'BOOLEAN' or 'галочка' in col_name.lower():
-                    data[col_name] = 1 if form_value == '1' else 0
-                elif col['type'] == 'DATE' and form_value:
-                    data[col_name] = datetime.strptime(form_value, '%Y-%m-%d').date()
-                elif col['type'] == 'DATETIME' and form_value:
-                    data[col_name] = datetime.strptime(form_value, '%Y-%m-%dT%H:%M')
-                else:
-                    data[col_name] = form_value
+        # Первичный ключ не меняем
+        try:
+            data = build_record_data(columns_meta, request.form, skip=(primary_key,))
+        except RequiredFieldError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('edit_record', table_name=table_name, row_id=primary_key_value))
         
         # Строим UPDATE запрос
         set_clause = ', '.join([f'`{col}` = :{col}' for col in data.keys()])
@@ -700,8 +4293,16 @@ def update_record():
         # Добавляем значение первичного ключа
         data['pk_value'] = primary_key_value
         
-        with engine.begin() as conn:
+        # Прежняя запись - чтобы поправить частоты подсказок и сводку отчета
+        with get_engine().begin() as conn:
+            report_state = lock_report_state(conn, table_name)
+            old = conn.execute(text(f"SELECT * FROM `{table_name}` WHERE `{primary_key}` = :pk_value"),
+                               data).mappings().first()
             conn.execute(update_query, data)
+            update_report_summaries(conn, table_name, report_state, [(dict(old or {}), data)])
+        table_data_changed(table_name, changes=[(dict(old or {}), data)])
+        audit('record_update', table=table_name, id=primary_key_value,
+              columns=[col for col in data if col != 'pk_value'])
         
         flash('Запись успешно обновлена!', 'success')
         return redirect(f'/orex-ws/table?name={table_name}')
@@ -711,6 +4312,230 @@ def update_record():
         flash(f'Ошибка при обновлении: {str(e)}', 'danger')
         return redirect(url_for('edit_record', table_name=table_name, row_id=primary_key_value))
 
+@orex.route('/orex-ws/bulk_update', methods=['POST'])
+def bulk_update():
+    """Групповая правка: одни и те же значения колонок для выбранных записей.
+    
+    Один UPDATE ... WHERE pk IN (...) в одной транзакции; в ответе - только
+    изменившиеся ячейки, страница обновляет их на месте без перезагрузки.
+    """
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'message': 'Требуется авторизация'}), 401
+    
+    # Дополнительная проверка безопасности
+    ip = get_remote_address()
+    fingerprint = session.get('fingerprint', '')
+    
+    if ip != session.get('ip'):
+        session.clear()
+        return jsonify({'success': False, 'message': 'Security error'}), 403
+
+    if not check_whitelist(ip, fingerprint):
+        session.clear()
+        return jsonify({'success': False, 'message': 'Security error'}), 403
+    
+    table_name = request.form.get('table_name')
+    row_ids = [row_id for row_id in request.form.getlist('row_ids') if row_id]
+    chosen = set(request.form.getlist('columns'))
+    
+    if not table_name or not row_ids or not chosen:
+        return jsonify({'success': False, 'message': 'Не выбраны записи или колонки'}), 400
+    
+    if len(row_ids) > BULK_EDIT_MAX_ROWS:
+        return jsonify({'success': False,
+                        'message': f'За один раз можно изменить не больше {BULK_EDIT_MAX_ROWS} записей'}), 400
+    
+    try:
+        schema = get_table_schema(table_name)
+        primary_key = schema['primary_key']
+        if primary_key is None:
+            return jsonify({'success': False, 'message': 'У таблицы нет первичного ключа'}), 400
+        
+        # То же приведение типов, что и в форме редактирования, но только для выбранных колонок
+        try:
+            data = build_record_data([col for col in schema['columns'] if col['name'] in chosen],
+                                     request.form, skip=(primary_key,))
+        except (RequiredFieldError, ValueError) as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        if not data:
+            return jsonify({'success': False, 'message': 'Нечего менять'}), 400
+        
+        set_clause = ', '.join([f'`{col}` = :{col}' for col in data.keys()])
+        with get_engine().begin() as conn:
+            report_state = lock_report_state(conn, table_name)
+            # Прежние значения - для ответа, подсказок и сводки отчета
+            old_rows = conn.execute(
+                text(f"SELECT * FROM `{table_name}` WHERE `{primary_key}` IN :pk_values")
+                .bindparams(bindparam('pk_values', expanding=True)), {'pk_values': row_ids}
+            ).mappings().all()
+            conn.execute(
+                text(f"UPDATE `{table_name}` SET {set_clause} WHERE `{primary_key}` IN :pk_values")
+                .bindparams(bindparam('pk_values', expanding=True)), dict(data, pk_values=row_ids))
+            # Новые значения - в том виде, в каком их хранит БД: "5" из формы и 5 в колонке INT
+            # (или "10.5" и 10.50 в DECIMAL) - не изменение
+            columns_str = ', '.join(f'`{col}`' for col in [primary_key, *data])
+            new_rows = {row[primary_key]: row for row in conn.execute(
+                text(f"SELECT {columns_str} FROM `{table_name}` WHERE `{primary_key}` IN :pk_values")
+                .bindparams(bindparam('pk_values', expanding=True)), {'pk_values': row_ids}
+            ).mappings()}
+            update_report_summaries(conn, table_name, report_state, [(dict(old), data) for old in old_rows])
+        
+        diff = {}
+        for old in old_rows:
+            new = new_rows[old[primary_key]]
+            cells = {col: json_value(new[col]) for col in data
+                     if json_value(old[col]) != json_value(new[col])}
+            if cells:
+                diff[json_value(old[primary_key])] = cells
+        
+        table_data_changed(table_name, changes=[(dict(old), data) for old in old_rows])
+        audit('record_bulk_update', table=table_name, ids=[json_value(old[primary_key]) for old in old_rows],
+              columns=list(data))
+        
+        return jsonify({
+            'success': True,
+            'message': f'Изменено записей: {len(diff)} из {len(row_ids)}',
+            'diff': diff,
+            'missing': len(row_ids) - len(old_rows),
+        })
+    
+    except Exception as e:
+        logger.error(f"Bulk update error: {str(e)}")
+        return jsonify({'success': False, 'message': f'Ошибка при изменении: {str(e)}'}), 500
+
+@orex.route('/orex-ws/schema/invalidate', methods=['POST'])
+def invalidate_schema():
+    """Сброс кэша структуры таблиц (после правки таблиц в Adminer)"""
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'message': 'Требуется авторизация'}), 401
+    
+    # Дополнительная проверка безопасности
+    ip = get_remote_address()
+    fingerprint = session.get('fingerprint', '')
+    
+    if ip != session.get('ip'):
+        session.clear()
+        return jsonify({'success': False, 'message': 'Security error'}), 403
+
+    if not check_whitelist(ip, fingerprint):
+        session.clear()
+        return jsonify({'success': False, 'message': 'Security error'}), 403
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        table_name = data.get('table_name')
+        invalidate_schema_cache(table_name)
+        logger.info(f"Schema cache invalidated: {table_name or 'all tables'}")
+        return jsonify({'success': True, 'message': 'Кэш структуры таблиц сброшен'})
+    
+    except Exception as e:
+        logger.error(f"Schema invalidate error: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@orex.route('/orex-ws/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики для Prometheus: без входа - только напрямую с METRICS_ALLOWED_IPS, не через Apache"""
+    direct = request.remote_addr in METRICS_ALLOWED_IPS and 'X-Forwarded-For' not in request.headers
+    if not direct:
+        if not session.get('logged_in'):
+            return 'Требуется авторизация', 401
+        
+        # Дополнительная проверка безопасности
+        ip = get_remote_address()
+        fingerprint = session.get('fingerprint', '')
+        
+        if ip != session.get('ip') or is_ip_banned(ip) or not check_whitelist(ip, fingerprint):
+            session.clear()
+            return 'Security error', 403
+    
+    try:
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+    
+    except Exception as e:
+        logger.error(f"Metrics error: {str(e)}")
+        return f'Ошибка метрик: {str(e)}', 500
+
+@orex.route('/orex-ws/backups', methods=['GET'])
+def backups():
+    """Состояние резервных копий (сами бэкапы делает таймер orex-backup)"""
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    
+    # Дополнительная проверка безопасности
+    ip = get_remote_address()
+    fingerprint = session.get('fingerprint', '')
+    
+    if ip != session.get('ip'):
+        session.clear()
+        return redirect(url_for('login'))
+
+    if not check_whitelist(ip, fingerprint):
+        session.clear()
+        return redirect(url_for('login'))
+    
+    try:
+        return render_template('backups.html', backup_dir=BACKUP_DIR, status=backup_status(BACKUP_DIR))
+    
+    except Exception as e:
+        logger.error(f"Backup status error: {str(e)}")
+        return render_template('error.html', error=f'Не удалось прочитать {BACKUP_MANIFEST}: {str(e)}')
+
+@orex.route('/orex-ws/report', methods=['GET'])
+def report():
+    """Отчет по таблице из сводки: письма по месяцам или годам, в разрезе колонки-категории"""
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    
+    # Дополнительная проверка безопасности
+    ip = get_remote_address()
+    fingerprint = session.get('fingerprint', '')
+    
+    if ip != session.get('ip'):
+        session.clear()
+        return redirect(url_for('login'))
+
+    if not check_whitelist(ip, fingerprint):
+        session.clear()
+        return redirect(url_for('login'))
+    
+    table_name = request.args.get('table')
+    if not table_name:
+        return redirect(url_for('base'))
+    
+    try:
+        schema = get_table_schema(table_name)
+        definition = get_report_definition(table_name, schema)
+        if definition is None:
+            flash('Для отчета нужны колонка с датой и целый первичный ключ', 'danger')
+            return redirect(url_for('show_table', name=table_name))
+        
+        dimension = request.args.get('by', '')
+        if dimension not in definition['categories']:
+            dimension = ''
+        by_year = request.args.get('period') == 'year'
+        
+        engine = get_engine()
+        start = time.perf_counter()
+        counted = refresh_report(engine, table_name, definition)
+        data = load_report(engine, table_name, dimension, by_year)
+        elapsed_ms = round((time.perf_counter() - start) * 1000)
+        
+        columns = {col['name']: col for col in schema['columns']}
+        boolean = dimension and (columns[dimension]['type'] == 'BOOLEAN' or 'галочка' in dimension.lower())
+        return render_template('report.html',
+                               table_name=table_name,
+                               definition=definition,
+                               dimension=dimension,
+                               by_year=by_year,
+                               boolean=boolean,
+                               report=data,
+                               counted=counted,
+                               elapsed_ms=elapsed_ms)
+    
+    except Exception as e:
+        logger.error(f"Report error: {str(e)}")
+        return render_template('error.html', error=str(e))
+
 @orex.route('/orex-ws/delete_template', methods=['POST'])
 def delete_template():
     if not session.get('logged_in'):
@@ -741,6 +4566,7 @@ def delete_template():
             return jsonify({'success': False, 'message': 'Шаблон не найден'}), 404
         
         os.remove(template_path)
+        forget_compiled_template(template_path)
         logger.info(f"Template deleted: {template_path}")
         return jsonify({
             'success': True,
@@ -776,23 +4602,28 @@ def delete_record():
     primary_key = request.form['primary_key']
     
     try:
-        with engine.begin() as conn:
+        with get_engine().begin() as conn:
+            report_state = lock_report_state(conn, table_name)
+            
             # Получаем текущий максимальный ID
-            result = conn.execute(text(f"SELECT MAX(`{primary_key}`) as max_id FROM `{table_name}`"))
-            max_id_row = result.fetchone()
-            current_max = max_id_row['max_id'] if max_id_row else None
+            current_max = get_max_pk(conn, table_name, primary_key)
             
             # Проверяем, что удаляемая запись - последняя
             if current_max is None or int(row_id) != current_max:
                 flash('Можно удалять только последнюю запись!', 'danger')
                 return redirect(url_for('show_table', name=table_name))
             
-            # Удаляем запись
+            # Удаляем запись (прежние значения - для подсказок и сводки отчета)
+            old = conn.execute(text(f"SELECT * FROM `{table_name}` WHERE `{primary_key}` = :id"),
+                               {'id': row_id}).mappings().first()
             conn.execute(text(f"DELETE FROM `{table_name}` WHERE `{primary_key}` = :id"), {'id': row_id})
+            update_report_summaries(conn, table_name, report_state, [(dict(old), None)])
             
             # Устанавливаем автоинкремент на значение удаленной записи
             new_auto_increment = int(row_id)
             conn.execute(text(f"ALTER TABLE `{table_name}` AUTO_INCREMENT = {new_auto_increment}"))
+        table_data_changed(table_name, changes=[(dict(old), None)])
+        audit('record_delete', table=table_name, id=row_id)
         
         flash('Запись успешно удалена', 'success')
         return redirect(f'/orex-ws/table?name={table_name}')
@@ -802,16 +4633,20 @@ def delete_record():
         flash(f'Ошибка при удалении: {str(e)}', 'danger')
         return redirect(url_for('show_table', name=table_name))
 
-if __name__ == "__main__":
-    # Создаем пустые файлы безопасности при первом запуске
-    for filename in [SECURITY_WHITELIST, SECURITY_BLACKLIST, LOGIN_LOG]:
+def init_security_files():
+    """Создаем пустые файлы безопасности при первом запуске"""
+    for filename in [SECURITY_WHITELIST, SECURITY_BLACKLIST]:
         if not os.path.exists(filename):
             with open(filename, 'w', encoding='utf-8') as f:
                 if filename == SECURITY_WHITELIST:
                     f.write("# Security whitelist: IP|Fingerprint|Date\n")
                 elif filename == SECURITY_BLACKLIST:
                     f.write("# Security blacklist: IP|Reason|Date\n")
-                elif filename == LOGIN_LOG:
-                    f.write("# Login log: [Date] IP Fingerprint Status\n")
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['backup']:
+        sys.exit(backup_main(sys.argv[2:]))
     
+    # Отладочный сервер - только для разработки, на рабочем сервере запускаем через wsgi.py
+    init_security_files()
     orex.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
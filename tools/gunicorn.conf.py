@@ -0,0 +1,23 @@
+# Конфиг gunicorn для orex-ws
+# Запуск из папки проекта: gunicorn -c tools/gunicorn.conf.py wsgi:application
+import os
+
+# Apache проксирует /orex-ws на localhost:5000 (см. orex-ssl.conf)
+bind = os.environ.get('OREX_BIND', '127.0.0.1:5000')
+
+# На Orange Pi Zero3 4 ядра и мало памяти: 2 процесса по 4 потока.
+# Потоки нужны, чтобы долгая генерация документа не блокировала остальных
+workers = int(os.environ.get('OREX_WORKERS', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('OREX_THREADS', 4))
+
+# Выгрузка большой таблицы и пакетная генерация идут дольше стандартных 30 секунд
+timeout = 120
+graceful_timeout = 30
+
+# Рабочая папка - корень проекта (там лежат security-файлы)
+chdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+accesslog = '-'
+errorlog = '-'
+loglevel = 'info'
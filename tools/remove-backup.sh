@@ -19,6 +19,7 @@ systemctl daemon-reload
 
 # Удаляем скрипт
 rm -f /usr/local/bin/orex-backup.sh
+rm -rf /var/log/orex-backup
 
 # Удаляем конфиг (ОСТОРОЖНО! Это удалит все настройки)
 read -p "Удалить конфиг с паролями? (y/N): " confirm
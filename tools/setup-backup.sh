@@ -18,12 +18,18 @@ echo
 read -p "Введите имя базы данных для бэкапа: " db_name
 read -p "Куда складывать бэкапы? [/var/orex/backups]: " backup_dir
 backup_dir=${backup_dir:-/var/orex/backups}
+read -p "Папка OREX [/var/www/html/orex-workspace]: " orex_dir
+orex_dir=${orex_dir:-/var/www/html/orex-workspace}
 
 # Создаем папки
 mkdir -p /etc/orex
 mkdir -p "$backup_dir"
-chmod 700 /etc/orex "$backup_dir"
-chown root:root /etc/orex "$backup_dir"
+chmod 700 /etc/orex
+chown root:root /etc/orex
+# Папку бэкапов читает веб-приложение (страница "Резервные копии" - только manifest.json,
+# сами файлы бэкапов доступны только root)
+chmod 750 "$backup_dir"
+chown root:www-data "$backup_dir"
 
 # Сохраняем конфиг
 cat > "$CONFIG_FILE" << EOF
@@ -31,6 +37,7 @@ DB_USER="$db_user"
 DB_PASSWORD="$db_password"
 DB_NAME="$db_name"
 BACKUP_DIR="$backup_dir"
+OREX_DIR="$orex_dir"
 EOF
 
 chmod 600 "$CONFIG_FILE"
@@ -49,27 +56,20 @@ else
 fi
 
 # Функция бэкапа
+# Бэкап делает orex: полный снимок раз в неделю, каждый час - только изменившиеся
+# таблицы и строки, всё сжато. Проверка восстановления - раз в сутки
 do_backup() {
     echo "[$(date)] Запуск бэкапа БД $DB_NAME"
-    # Создаем временный конфиг для mysqldump
-    temp_cnf=$(mktemp)
-    cat > "$temp_cnf" << CONFIG
-[client]
-user=$DB_USER
-password=$DB_PASSWORD
-CONFIG
     
-    backup_file="$BACKUP_DIR/${DB_NAME}_backup_$(date +\%Y-\%m-\%d_\%H-\%M-\%S).sql"
-    
-    if mysqldump --defaults-file="$temp_cnf" "$DB_NAME" > "$backup_file"; then
-        echo "[+] Бэкап создан: $backup_file"
-        # Удаляем старые бэкапы (старше 60 дней)
-        find "$BACKUP_DIR" -name "*.sql" -mtime +60 -delete
+    # Логи бэкапа - отдельно от логов приложения (бэкап идет от root)
+    export OREX_LOG_DIR=/var/log/orex-backup
+    if "$OREX_DIR/venv/bin/python" "$OREX_DIR/orex.py" backup --config /etc/orex/.backup.conf; then
+        echo "[+] Бэкап создан: $BACKUP_DIR"
+        # Старые несжатые дампы прежней версии скрипта удаляются как раньше (старше 60 дней)
+        find "$BACKUP_DIR" -maxdepth 1 -name "*.sql" -mtime +60 -delete
     else
         echo "[-] Ошибка бэкапа!"
     fi
-    
-    rm -f "$temp_cnf"
 }
 
 # Проверяем права
@@ -113,4 +113,8 @@ systemctl start $SERVICE_NAME.timer
 echo "[+] Установка завершена!"
 echo "[+] Бэкап будет выполняться каждый час"
 echo "[+] Проверить: systemctl status $SERVICE_NAME.timer"
+echo "[+] Состояние бэкапов: $orex_dir/venv/bin/python $orex_dir/orex.py backup status"
+if [ "$backup_dir" != "/var/orex/backups" ]; then
+    echo "[!] Для страницы бэкапов добавьте в tools/orex.service: Environment=OREX_BACKUP_DIR=$backup_dir"
+fi
 EOF
\ No newline at end of file
@@ -0,0 +1,22 @@
+# Точка входа для рабочего сервера (production)
+#
+# gunicorn (основной вариант):
+#     gunicorn -c tools/gunicorn.conf.py wsgi:application
+#
+# waitress (чистый Python, если gunicorn недоступен):
+#     python wsgi.py
+import os
+
+from orex import orex as application, init_security_files
+
+# Файлы безопасности лежат в рабочей папке - работаем из папки проекта
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+init_security_files()
+
+if __name__ == "__main__":
+    from waitress import serve
+
+    serve(application,
+          host=os.environ.get('OREX_HOST', '127.0.0.1'),
+          port=int(os.environ.get('OREX_PORT', 5000)),
+          threads=int(os.environ.get('OREX_THREADS', 8)))